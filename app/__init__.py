@@ -14,6 +14,8 @@ from flask import Flask
 from flask.ext.httpauth import HTTPDigestAuth
 import settings
 
+from app.tokenauth import TokenAuth
+
 import Ice
 
 # Create Flask app
@@ -21,20 +23,32 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = os.urandom(24)
 
 # Initialize Digest Auth
-auth = HTTPDigestAuth()
+digest_auth = HTTPDigestAuth()
+
+# Select authentication: 'digest', 'token' (API keys) or 'both'
+auth_method = getattr(settings, 'AUTH_METHOD', 'digest')
+if auth_method == 'token':
+    auth = TokenAuth(getattr(settings, 'API_KEYS', {}))
+elif auth_method == 'both':
+    auth = TokenAuth(getattr(settings, 'API_KEYS', {}), fallback=digest_auth)
+else:
+    auth = digest_auth
 
-# If enabled, all endpoints will be digest auth protected
+# If enabled, all endpoints will be auth protected
 auth_enabled = settings.ENABLE_AUTH
 
 # Load up Murmur slice file into Ice
 Ice.loadSlice('', ['-I' + Ice.getSliceDir(), os.path.join(settings.MURMUR_ROOT, settings.SLICE_FILE)])
 import Murmur
+from app.resilience import GuardedProxy
 
 # Configure Ice properties
 props = Ice.createProperties()
 props.setProperty("Ice.ImplicitContext", "Shared")
 props.setProperty('Ice.Default.EncodingVersion', '1.0')
 props.setProperty('Ice.MessageSizeMax', str(settings.ICE_MESSAGESIZE))
+props.setProperty('Ice.Override.ConnectTimeout', str(getattr(settings, 'ICE_CONNECT_TIMEOUT', 2000)))
+props.setProperty('Ice.RetryIntervals', getattr(settings, 'ICE_RETRY_INTERVALS', '0'))
 idata = Ice.InitializationData()
 idata.properties = props
 
@@ -44,7 +58,28 @@ proxy = ice.stringToProxy(settings.ICE_HOST.encode('ascii'))
 secret = settings.ICE_SECRET.encode('ascii')
 if secret != '':
 	ice.getImplicitContext().put("secret", secret)
-meta = Murmur.MetaPrx.checkedCast(proxy)
+meta = GuardedProxy(Murmur.MetaPrx.checkedCast(proxy))
+
+# Cache server proxies to avoid a getServer round trip per request
+from app import events
+from app.servercache import ServerCache
+server_cache = ServerCache(meta)
+events.subscribe(server_cache.on_event)
+server_cache.start()
 
 # Load route endpoints
-from app import api
\ No newline at end of file
+from app import api
+
+# Start webhook delivery and register for Murmur callbacks
+from app.webhooks import start_webhooks
+from app.events import start_callbacks
+start_webhooks()
+start_callbacks(ice, meta)
+
+# Start tailing server logs into the local search index
+from app.logindex import start_log_ingester
+start_log_ingester(meta)
+
+# Start sampling server occupancy history
+from app.history import start_sampler
+start_sampler(meta)
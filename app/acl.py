@@ -0,0 +1,130 @@
+"""
+acl.py
+Named ACL templates and helpers for applying them to channels.
+
+:copyright: (C) 2014 by github.com/alfg.
+:license:   MIT, see README for more details.
+"""
+
+from app.fanout import pipeline, error_name
+
+import Murmur
+
+# Enter, traverse, speak, whisper and text message.
+JOIN_AND_SPEAK = 910L
+
+
+def make_acl(group, allow=0, deny=0):
+    """
+    Builds a channel-local ACL entry for a group.
+    """
+    acl = Murmur.ACL()
+    acl.applyHere = True
+    acl.applySubs = False
+    acl.inherited = False
+    acl.userid = -1
+    acl.group = group
+    acl.allow = allow
+    acl.deny = deny
+    return acl
+
+
+def password_template(password=None, **params):
+    """
+    Only allow people that know the password to join and speak.
+    """
+    if not password:
+        raise ValueError("Password required.")
+    return [
+        make_acl("all", deny=JOIN_AND_SPEAK),
+        make_acl("#" + password, allow=JOIN_AND_SPEAK),
+    ]
+
+
+def moderated_template(**params):
+    """
+    By default don't allow users to speak in moderated rooms.
+    """
+    return [make_acl("all", deny=Murmur.PermissionSpeak)]
+
+
+def readonly_template(**params):
+    """
+    Users may enter and listen, but not speak, whisper, write or create channels.
+    """
+    return [make_acl("all", deny=(Murmur.PermissionSpeak | Murmur.PermissionWhisper |
+                                  Murmur.PermissionTextMessage | Murmur.PermissionMakeChannel |
+                                  Murmur.PermissionMakeTempChannel))]
+
+
+def open_template(**params):
+    """
+    Removes all channel-local ACLs, leaving only inherited ones.
+    """
+    return []
+
+
+TEMPLATES = {
+    'password': password_template,
+    'moderated': moderated_template,
+    'readonly': readonly_template,
+    'open': open_template,
+}
+
+
+def build_acls(template, **params):
+    """
+    Builds the ACL list for a named template. Raises KeyError for unknown
+    templates and ValueError for missing parameters.
+    """
+    return TEMPLATES[template](**params)
+
+
+def acl_key(acl):
+    """
+    Comparable representation of an ACL entry.
+    """
+    return (acl.applyHere, acl.applySubs, acl.userid, acl.group, int(acl.allow), int(acl.deny))
+
+
+def acls_equal(current, target):
+    """
+    Compares the channel-local part of a fetched ACL list with a target list.
+    """
+    local = [acl_key(a) for a in current if not a.inherited]
+    return local == [acl_key(a) for a in target]
+
+
+def apply_acls(targets, acls):
+    """
+    Applies an ACL list to many (server id, server, channel id) targets.
+
+    ACLs are fetched and written with pipelined calls, and channels that already
+    match are left untouched. Returns a list of per-channel result dicts.
+    """
+    targets = list(targets)
+    proxies = dict(((sid, channel), s) for sid, s, channel in targets)
+
+    results = []
+    writes = []
+    fetched = pipeline(((sid, channel), s, 'getACL', (channel,)) for sid, s, channel in targets)
+    for key, current, error in fetched:
+        if error is not None:
+            results.append({'id': key[0], 'channel_id': key[1], 'status': error_name(error)})
+            continue
+
+        current_acls, groups, inherit = current
+        if acls_equal(current_acls, acls):
+            results.append({'id': key[0], 'channel_id': key[1], 'status': 'Unchanged'})
+            continue
+
+        writes.append((key, proxies[key], 'setACL', (key[1], acls, groups, inherit)))
+
+    for key, _, error in pipeline(writes):
+        results.append({
+            'id': key[0],
+            'channel_id': key[1],
+            'status': 'Updated' if error is None else error_name(error)
+        })
+
+    return results
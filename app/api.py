@@ -6,15 +6,29 @@ All API route endpoints
 :license:   MIT, see README for more details.
 """
 
+import sqlite3
 from datetime import timedelta
 
 from flask import request, jsonify, json, Response
 from flask.ext.classy import FlaskView, route
 
-from app import app, meta, auth, auth_enabled
-from app.utils import obj_to_dict, get_server_conf, get_server_port, get_all_users_count, conditional, support_jsonp
+from app import app, meta, server_cache, auth, auth_enabled
+from app.utils import obj_to_dict, get_server_conf, get_server_port, get_all_users_count, conditional, support_jsonp, is_true
 from app.cvp import cvp_chan_to_dict
-
+from app.fanout import pipeline, select_servers, error_name, parse_ids, server_id
+from app.moderation import ACTIONS, resolve_targets, moderate
+from app.rollout import RESERVED_KEYS, conf_diff, rollout
+from app.bans import get_ban_index, forget_ban_index, make_ban, ban_to_dict, parse_cidr
+from app.logindex import search as search_logs, forget_index as forget_log_index
+from app.history import parse_resolution, get_history, forget_history, aggregate
+from app.textures import textures
+from app.provision import SERVER_TEMPLATES, CONF_KEYS, BULK_CREATE_LIMIT, MAX_PORT, provision
+from app import webhooks
+from app.resilience import CircuitOpenError, breaker_states
+from app.userindex import users as user_index
+from app.acl import TEMPLATES as ACL_TEMPLATES, build_acls, acls_equal, apply_acls
+
+import Ice
 import Murmur
 
 
@@ -62,7 +76,7 @@ class ServersView(FlaskView):
         """
 
         id = long(id)
-        s = meta.getServer(id)
+        s = server_cache.get(id)
 
         # Return 404 if not found
         if s is None:
@@ -104,36 +118,53 @@ class ServersView(FlaskView):
         Creates a server, starts server, and returns id
         """
 
-        # Basic Configuration
-        password = request.form.get('password')
-        port = request.form.get('port')  # Defaults to inifile+server_id-1
-        timeout = request.form.get('timeout')
-        bandwidth = request.form.get('bandwidth')
-        users = request.form.get('users')
-        welcometext = request.form.get('welcometext')
-
-        # Data for registration in the public server list
-        registername = request.form.get('registername')
-        registerpassword = request.form.get('registerpassword')
-        registerhostname = request.form.get('registerhostname')
-        registerurl = request.form.get('registerurl')
+        # Basic configuration, port defaults to inifile+server_id-1,
+        # and data for registration in the public server list
+        conf = dict((key, request.form.get(key)) for key in CONF_KEYS + ('port',) if request.form.get(key))
 
         # Create server
         server = meta.newServer()
+        server_cache.add(server_id(server), server)
 
         # Set conf if provided
-        server.setConf('password', password) if password else None
-        server.setConf('port', port) if port else None
-        server.setConf('timeout', timeout) if timeout else None
-        server.setConf('bandwidth', bandwidth) if bandwidth else None
-        server.setConf('users', users) if users else None
-        server.setConf('welcometext', welcometext) if welcometext else None
-        server.setConf('registername', registername) if registername else None
+        for key, value in conf.iteritems():
+            server.setConf(key, value)
 
         # Start server
         server.start()
 
-        return self.get(server.id())
+        return self.get(server_id(server))
+
+    @conditional(auth.login_required, auth_enabled)
+    @route('bulk', methods=['POST'])
+    def bulk_create(self):
+        """
+        Creates many servers from a template with non-conflicting ports, and returns ids and ports
+        """
+
+        template = request.form.get('template', 'default')
+        if template not in SERVER_TEMPLATES:
+            return jsonify(message="Template must be one of: %s." % ', '.join(sorted(SERVER_TEMPLATES))), 400
+
+        count = request.form.get('count', 1, type=int)
+        if not 0 < count <= BULK_CREATE_LIMIT:
+            return jsonify(message="Count must be between 1 and %d." % BULK_CREATE_LIMIT), 400
+
+        # Form values override the template
+        conf = dict(SERVER_TEMPLATES[template])
+        conf.update((key, request.form.get(key)) for key in CONF_KEYS if request.form.get(key))
+
+        port = request.form.get('port')
+        if port and not (port.isdigit() and 0 < int(port) <= MAX_PORT):
+            return jsonify(message="Port must be between 1 and %d." % MAX_PORT), 400
+
+        start = is_true(request.form.get('start', 'true'))
+        try:
+            results = provision(meta, count, conf, port, start, cache=server_cache)
+        except ValueError, e:
+            return jsonify(message=str(e)), 400
+
+        return Response(json.dumps(results, sort_keys=True, indent=4), mimetype='application/json')
 
     @conditional(auth.login_required, auth_enabled)
     def delete(self, id):
@@ -141,7 +172,7 @@ class ServersView(FlaskView):
         Shuts down and deletes a server
         """
 
-        server = meta.getServer(int(id))
+        server = server_cache.get(int(id))
 
         # Return 404 if not found
         if server is None:
@@ -153,6 +184,11 @@ class ServersView(FlaskView):
 
         # Delete server instance
         server.delete()
+        server_cache.discard(int(id))
+        forget_ban_index(int(id))
+        textures.invalidate(int(id))
+        forget_history(int(id))
+        forget_log_index(int(id))
         return jsonify(message="Server deleted")
 
     @conditional(auth.login_required, auth_enabled)
@@ -170,15 +206,26 @@ class ServersView(FlaskView):
 
         # Delete each server.
         for i in ids:
-            server = meta.getServer(i)
+            server = server_cache.get(i)
 
             if not server:
                 continue
 
-            if server.isRunning():
-                server.stop()
+            try:
+                if server.isRunning():
+                    server.stop()
+
+                server.delete()
+            except Ice.ObjectNotExistException:
+                # Deleted outside the API since it was cached
+                server_cache.discard(i)
+                continue
 
-            server.delete()
+            server_cache.discard(i)
+            forget_ban_index(i)
+            textures.invalidate(i)
+            forget_history(i)
+            forget_log_index(i)
 
         return jsonify(message="Deleting servers.", ids=ids)
 
@@ -191,7 +238,7 @@ class ServersView(FlaskView):
         """ Starts server
         """
 
-        server = meta.getServer(id)
+        server = server_cache.get(id)
 
         # Return 404 if not found
         if server is None:
@@ -211,7 +258,7 @@ class ServersView(FlaskView):
         """ Stops server
         """
 
-        server = meta.getServer(id)
+        server = server_cache.get(id)
 
         # Return 404 if not found
         if server is None:
@@ -231,7 +278,7 @@ class ServersView(FlaskView):
         """ Gets all server logs by server ID
         """
 
-        server = meta.getServer(id)
+        server = server_cache.get(id)
 
         # Return 404 if not found
         if server is None:
@@ -246,13 +293,54 @@ class ServersView(FlaskView):
             })
         return Response(json.dumps(logs, sort_keys=True, indent=4), mimetype='application/json')
 
+    @conditional(auth.login_required, auth_enabled)
+    @route('<int:id>/logs/search', methods=['GET'])
+    def logs_search(self, id):
+        """ Searches server logs from the local index, without querying Murmur.
+        """
+
+        query = request.args.get('q')
+        since = request.args.get('since', type=int)
+        limit = request.args.get('limit', 100, type=int)
+
+        try:
+            logs = search_logs(id, query, since, limit)
+        except sqlite3.OperationalError, e:
+            return jsonify(message="Invalid query: %s" % e), 400
+
+        # Return 404 if the server's log has not been indexed
+        if logs is None:
+            return jsonify(message="Not Found"), 404
+
+        return Response(json.dumps(logs, sort_keys=True, indent=4), mimetype='application/json')
+
+    @conditional(auth.login_required, auth_enabled)
+    @route('<int:id>/history', methods=['GET'])
+    def history(self, id):
+        """ Gets users online and channel count over time, from the local history.
+        """
+
+        try:
+            resolution = parse_resolution(request.args.get('resolution'))
+        except ValueError, e:
+            return jsonify(message=str(e)), 400
+
+        history = get_history(id)
+
+        # Return 404 if nothing was recorded for the server
+        if history is None:
+            return jsonify(message="Not Found"), 404
+
+        data = history.series(resolution)
+        return Response(json.dumps(data, sort_keys=True, indent=4), mimetype='application/json')
+
     @conditional(auth.login_required, auth_enabled)
     @route('<int:id>/user/<user>', methods=['DELETE'])
     def user_del_user(self, id, user):
         """ Deletes user
         """
 
-        server = meta.getServer(id)
+        server = server_cache.get(id)
 
         # Return 404 if not found
         if server is None:
@@ -264,6 +352,7 @@ class ServersView(FlaskView):
             return jsonify(message="No User Found for ID " + str(user)), 500
 
         server.unregisterUser(int(user))
+        textures.invalidate(id, int(user))
 
         json_data = {
             "user_id": user,
@@ -277,7 +366,7 @@ class ServersView(FlaskView):
         """ Mutes a user
         """
 
-        server = meta.getServer(id)
+        server = server_cache.get(id)
 
         if server is None:
             return jsonify(message="Server Not Found"), 404
@@ -304,7 +393,7 @@ class ServersView(FlaskView):
         """ Unmutes a user
         """
 
-        server = meta.getServer(id)
+        server = server_cache.get(id)
 
         if server is None:
             return jsonify(message="Server Not Found"), 404
@@ -325,13 +414,67 @@ class ServersView(FlaskView):
         }
         return Response(json.dumps(json_data, sort_keys=True, indent=4), mimetype='application/json')
 
+    @conditional(auth.login_required, auth_enabled)
+    @route('<int:id>/user/<int:userid>/texture', methods=['GET'])
+    def user_texture(self, id, userid):
+        """ Gets a registered user's texture (avatar)
+        """
+
+        server = server_cache.get(id)
+
+        # Return 404 if not found
+        if server is None:
+            return jsonify(message="Not Found"), 404
+
+        try:
+            texture = textures.get(id, userid, lambda: server.getTexture(userid))
+        except Murmur.InvalidUserException:
+            return jsonify(message="User Not Found"), 404
+        except Murmur.ServerBootedException:
+            return jsonify(message="Server not running."), 409
+
+        if not texture.data:
+            return jsonify(message="No Texture"), 404
+
+        response = Response(texture.data, mimetype=texture.content_type)
+        response.set_etag(texture.etag)
+        return response.make_conditional(request)
+
+    @conditional(auth.login_required, auth_enabled)
+    @route('<int:id>/user/<int:userid>/texture', methods=['POST'])
+    def user_set_texture(self, id, userid):
+        """ Sets a registered user's texture. Upload as file 'texture' or raw request body.
+        """
+
+        server = server_cache.get(id)
+
+        # Return 404 if not found
+        if server is None:
+            return jsonify(message="Not Found"), 404
+
+        upload = request.files.get('texture')
+        data = upload.read() if upload else request.get_data()
+
+        try:
+            server.setTexture(userid, data)
+        except Murmur.InvalidUserException:
+            return jsonify(message="User Not Found"), 404
+        except Murmur.InvalidTextureException:
+            return jsonify(message="Invalid Texture"), 400
+        except Murmur.ServerBootedException:
+            return jsonify(message="Server not running."), 409
+        finally:
+            textures.invalidate(id, userid)
+
+        return jsonify(message="Texture updated.")
+
     @conditional(auth.login_required, auth_enabled)
     @route('<int:id>/user', methods=['POST'])
     def user_new_user(self, id):
         """ Creates user
         """
 
-        server = meta.getServer(id)
+        server = server_cache.get(id)
 
         # Return 404 if not found
         if server is None:
@@ -362,7 +505,7 @@ class ServersView(FlaskView):
         """ Gets registered user by ID
         """
 
-        server = meta.getServer(id)
+        server = server_cache.get(id)
 
         # Return 404 if not found
         if server is None:
@@ -382,7 +525,7 @@ class ServersView(FlaskView):
         """ Gets all users on server
         """
 
-        server = meta.getServer(id)
+        server = server_cache.get(id)
 
         # Return 404 if not found
         if server is None:
@@ -398,7 +541,7 @@ class ServersView(FlaskView):
         """ Creates channel
         """
 
-        server = meta.getServer(id)
+        server = server_cache.get(id)
 
         # Return 404 if not found
         if server is None:
@@ -419,7 +562,7 @@ class ServersView(FlaskView):
         """ Deletes channel
         """
 
-        server = meta.getServer(id)
+        server = server_cache.get(id)
 
         # Return 404 if not found
         if server is None:
@@ -444,7 +587,7 @@ class ServersView(FlaskView):
         """ Gets all channels in server
         """
 
-        server = meta.getServer(id)
+        server = server_cache.get(id)
 
         # Return 404 if not found
         if server is None:
@@ -460,7 +603,7 @@ class ServersView(FlaskView):
         """ Gets a specific channel from a server
         """
 
-        server = meta.getServer(id)
+        server = server_cache.get(id)
 
         # Return 404 if not found
         if server is None:
@@ -476,7 +619,7 @@ class ServersView(FlaskView):
         """ Gets all banned IPs in server
         """
 
-        server = meta.getServer(id)
+        server = server_cache.get(id)
 
         # Return 404 if not found
         if server is None:
@@ -485,13 +628,62 @@ class ServersView(FlaskView):
         data = obj_to_dict(server.getBans())
         return Response(json.dumps(data, sort_keys=True, indent=4), mimetype='application/json')
 
+    @conditional(auth.login_required, auth_enabled)
+    @route('<int:id>/bans', methods=['POST'])
+    def ban_add(self, id):
+        """ Bans an address or CIDR range. formdata: address, name, hash, reason, duration
+        """
+
+        return self._update_bans(id, add=[dict(request.form.items())])
+
+    @conditional(auth.login_required, auth_enabled)
+    @route('<int:id>/bans', methods=['DELETE'])
+    def ban_remove(self, id):
+        """ Removes the ban for an address or CIDR range.
+        """
+
+        address = request.args.get('address') or request.form.get('address')
+        return self._update_bans(id, remove=[address], required=True)
+
+    @conditional(auth.login_required, auth_enabled)
+    @route('<int:id>/bans/bulk', methods=['POST'])
+    def ban_bulk(self, id):
+        """ Adds and removes many bans with a single write.
+        JSON body: {"add": [{"address": ..., "reason": ...}], "remove": ["1.2.3.0/24"]}
+        """
+
+        data = request.get_json(force=True, silent=True) or {}
+        return self._update_bans(id, add=data.get('add', []), remove=data.get('remove', []))
+
+    @conditional(auth.login_required, auth_enabled)
+    @route('<int:id>/bans/check', methods=['GET'])
+    def ban_check(self, id):
+        """ Checks whether an IP address is banned.
+        """
+
+        server = server_cache.get(id)
+
+        # Return 404 if not found
+        if server is None:
+            return jsonify(message="Not Found"), 404
+
+        address = request.args.get('address')
+        try:
+            bans = get_ban_index(id, server).lookup(address)
+        except ValueError, e:
+            return jsonify(message=str(e)), 400
+        except Murmur.ServerBootedException:
+            return jsonify(message="Server not running."), 409
+
+        return jsonify(address=address, banned=bool(bans), bans=[ban_to_dict(b) for b in bans])
+
     @conditional(auth.login_required, auth_enabled)
     @route('<int:id>/conf', methods=['GET'])
     def conf(self, id):
         """ Gets all configuration in server
         """
 
-        server = meta.getServer(id)
+        server = server_cache.get(id)
 
         # Return 404 if not found
         if server is None:
@@ -510,7 +702,7 @@ class ServersView(FlaskView):
         value = request.form.get('value')
 
         if key and value:
-            server = meta.getServer(id)
+            server = server_cache.get(id)
 
             # Return 404 if not found
             if server is None:
@@ -519,29 +711,63 @@ class ServersView(FlaskView):
             server.setConf(key, value)
             return jsonify(message="Configuration updated.")
         else:
-            server = meta.getServer(id)
+            server = server_cache.get(id)
 
             # Return 404 if not found
             if server is None:
                 return jsonify(message="Not Found"), 404
 
-            count = 0
-            for key, val in request.form.items():
-                count += 1
-                server.setConf(key, val)
-
-            if count > 0:
-                return jsonify(message="Configuration updated: %d values." % count)
-            else:
+            patch = dict(request.form.items())
+            if not patch:
                 return jsonify(message="Configuration key and value required.")
 
+            # Only write values that actually change
+            diff = conf_diff(server.getAllConf(), meta.getDefaultConf(), patch, id)
+            for key, change in diff.iteritems():
+                server.setConf(key, change['new'])
+
+            return jsonify(message="Configuration updated: %d values." % len(diff))
+
+    @conditional(auth.login_required, auth_enabled)
+    @route('conf', methods=['POST'])
+    def rollout_conf(self):
+        """ Rolls out configuration variables to many servers, writing only changed values.
+        """
+
+        patch = dict((k, v) for k, v in request.form.items() if k not in RESERVED_KEYS)
+        if not patch:
+            return jsonify(message="Configuration key and value required.")
+
+        dry_run = is_true(request.form.get('dry_run'))
+        stream = is_true(request.form.get('stream'))
+
+        targets, missing = select_servers(meta, request.form)
+        chunks = rollout(meta, targets, patch, dry_run)
+
+        if stream:
+            # Newline delimited JSON: results and a progress line after every chunk
+            def generate():
+                for result in missing:
+                    yield json.dumps(result) + '\n'
+                for results, done, total in chunks:
+                    for result in results:
+                        yield json.dumps(result) + '\n'
+                    yield json.dumps({'progress': {'done': done, 'total': total}}) + '\n'
+            return Response(generate(), mimetype='application/x-ndjson')
+
+        results = missing
+        for chunk, done, total in chunks:
+            results.extend(chunk)
+
+        return Response(json.dumps(results, sort_keys=True, indent=4), mimetype='application/json')
+
     @conditional(auth.login_required, auth_enabled)
     @route('<int:id>/channels/<int:channel_id>/acl', methods=['GET'])
     def channel_acl(self, id, channel_id):
         """ Gets all channel ACLs in server
         """
 
-        server = meta.getServer(id)
+        server = server_cache.get(id)
 
         # Return 404 if not found
         if server is None:
@@ -558,44 +784,22 @@ class ServersView(FlaskView):
 
         password = request.form.get("password")
 
-        server = meta.getServer(id)
+        server = server_cache.get(id)
 
         # Return 404 if not found
         if server is None:
             return jsonify(message="Not Found"), 404
 
         try:
-            settings = server.getACL(channel_id)
+            acl_list = build_acls('password', password=password)
+        except ValueError, e:
+            return jsonify(message=str(e)), 400
+
+        try:
+            self._set_channel_acl(server, channel_id, acl_list)
         except Murmur.InvalidChannelException:
             return jsonify(message="Channel Not Found"), 404
 
-        acls, groups, inherit = settings
-
-        acl_list = []
-        # Don't allow anyone in the channel
-        deny_acl = Murmur.ACL()
-        deny_acl.applyHere = True
-        deny_acl.applySubs = False
-        deny_acl.inherited = False
-        deny_acl.userid = -1
-        deny_acl.group = "all"
-        deny_acl.allow = 0
-        deny_acl.deny = 910L
-        acl_list.append(deny_acl)
-
-        # Only allow people that know the password to join and speak
-        password_acl = Murmur.ACL()
-        password_acl.applyHere = True
-        password_acl.applySubs = False
-        password_acl.inherited = False
-        password_acl.userid = -1
-        password_acl.group = "#" + password
-        password_acl.allow = 910L
-        password_acl.deny = 0
-        acl_list.append(password_acl)
-
-        server.setACL(channel_id, acl_list, groups, inherit)
-
         data = {
             "channel_id": channel_id,
             "set_password": 'Success'
@@ -611,33 +815,17 @@ class ServersView(FlaskView):
 
         moderator_id = request.form.get("moderator_id")
 
-        server = meta.getServer(id)
+        server = server_cache.get(id)
 
         # Return 404 if not found
         if server is None:
             return jsonify(message="Not Found"), 404
 
         try:
-            settings = server.getACL(channel_id)
+            self._set_channel_acl(server, channel_id, build_acls('moderated'))
         except Murmur.InvalidChannelException:
             return jsonify(message="Channel Not Found"), 404
 
-        acls, groups, inherit = settings
-
-        acl_list = []
-        # By default don't allow users to speak in moderated rooms
-        deny_acl = Murmur.ACL()
-        deny_acl.applyHere = True
-        deny_acl.applySubs = False
-        deny_acl.inherited = False
-        deny_acl.userid = -1
-        deny_acl.group = "all"
-        deny_acl.allow = 0
-        deny_acl.deny = 8L
-        acl_list.append(deny_acl)
-
-        server.setACL(channel_id, acl_list, groups, inherit)
-
         data = {
             "channel_id": channel_id,
             "set_password": 'Success'
@@ -645,6 +833,34 @@ class ServersView(FlaskView):
 
         return Response(json.dumps(data, sort_keys=True, indent=4), mimetype='application/json')
 
+    @conditional(auth.login_required, auth_enabled)
+    @route('acl', methods=['POST'])
+    def apply_acl_template(self):
+        """ Applies a named ACL template to channels on many servers.
+        """
+
+        template = request.form.get('template')
+        channels = parse_ids(request.form.get('channels'))
+
+        if template not in ACL_TEMPLATES:
+            return jsonify(message="Template must be one of: %s." % ', '.join(sorted(ACL_TEMPLATES))), 400
+
+        if not channels:
+            return jsonify(message="Channels required."), 400
+
+        try:
+            acl_list = build_acls(template, password=request.form.get('password'))
+        except ValueError, e:
+            return jsonify(message=str(e)), 400
+
+        targets, results = select_servers(meta, request.form)
+        results.extend(apply_acls(
+            ((sid, s, c) for sid, s in targets for c in channels),
+            acl_list
+        ))
+
+        return Response(json.dumps(results, sort_keys=True, indent=4), mimetype='application/json')
+
     @conditional(auth.login_required, auth_enabled)
     @route('<int:id>/sendmessage', methods=['POST'])
     def send_message(self, id):
@@ -654,7 +870,7 @@ class ServersView(FlaskView):
         message = request.form.get('message')
 
         if message:
-            server = meta.getServer(id)
+            server = server_cache.get(id)
 
             # Return 404 if not found
             if server is None:
@@ -665,6 +881,28 @@ class ServersView(FlaskView):
         else:
             return jsonify(message="Message required.")
 
+    @conditional(auth.login_required, auth_enabled)
+    @route('broadcast', methods=['POST'])
+    def broadcast(self):
+        """ Sends a message to all channels on many servers at once.
+        """
+
+        message = request.form.get('message')
+
+        if not message:
+            return jsonify(message="Message required.")
+
+        targets, results = select_servers(meta, request.form)
+        calls = [(sid, s, 'sendMessageChannel', (0, True, message)) for sid, s in targets]
+
+        for sid, _, error in pipeline(calls):
+            results.append({
+                'id': sid,
+                'status': 'Sent' if error is None else error_name(error)
+            })
+
+        return Response(json.dumps(results, sort_keys=True, indent=4), mimetype='application/json')
+
     @conditional(auth.login_required, auth_enabled)
     @route('<int:id>/setsuperuserpw', methods=['POST'])
     def set_superuser_pw(self, id):
@@ -674,7 +912,7 @@ class ServersView(FlaskView):
         password = request.form.get('password')
 
         if password:
-            server = meta.getServer(id)
+            server = server_cache.get(id)
 
             # Return 404 if not found
             if server is None:
@@ -695,7 +933,7 @@ class ServersView(FlaskView):
         reason = request.form.get("reason", "Reason not defined.")  # Reason messaged for being kicked.
 
         if user_session:
-            server = meta.getServer(id)
+            server = server_cache.get(id)
 
             # Return 404 if not found
             if server is None:
@@ -711,6 +949,79 @@ class ServersView(FlaskView):
         else:
             return jsonify(message="User session required.")
 
+    @conditional(auth.login_required, auth_enabled)
+    @route('<int:id>/moderate', methods=['POST'])
+    def moderate_users(self, id):
+        """ Mutes, unmutes, kicks or moves many users at once.
+        """
+
+        action = request.form.get('action')
+        if action not in ACTIONS:
+            return jsonify(message="Action must be one of: %s." % ', '.join(ACTIONS)), 400
+
+        sessions = parse_ids(request.form.get('sessions'))
+        userids = parse_ids(request.form.get('userids'))
+        channel = request.form.get('channel')
+        channel = int(channel) if channel else None
+        target = request.form.get('target')  # Channel ID to move users into
+
+        if not (sessions or userids or channel is not None):
+            return jsonify(message="Sessions, userids or channel required."), 400
+
+        if action == 'move' and not target:
+            return jsonify(message="Target channel required."), 400
+
+        server = server_cache.get(id)
+
+        # Return 404 if not found
+        if server is None:
+            return jsonify(message="Not Found"), 404
+
+        try:
+            users = server.getUsers()
+        except Murmur.ServerBootedException:
+            return jsonify(message="Server not running."), 409
+
+        matched, results = resolve_targets(users, sessions, userids, channel)
+        results.extend(moderate(server, matched, action,
+                                reason=request.form.get('reason', "Reason not defined."),
+                                target_channel=int(target) if target else None))
+
+        return Response(json.dumps(results, sort_keys=True, indent=4), mimetype='application/json')
+
+
+    def _set_channel_acl(self, server, channel_id, acl_list):
+        """ Replaces a channel's local ACLs, skipping the write if nothing changed.
+        """
+        acls, groups, inherit = server.getACL(channel_id)
+        if acls_equal(acls, acl_list):
+            return False
+        server.setACL(channel_id, acl_list, groups, inherit)
+        return True
+
+    def _update_bans(self, id, add=(), remove=(), required=False):
+        """ Applies ban changes through the server's ban index. If `required`,
+            returns 404 when nothing was removed.
+        """
+        server = server_cache.get(id)
+
+        # Return 404 if not found
+        if server is None:
+            return jsonify(message="Not Found"), 404
+
+        try:
+            bans = [make_ban(b.get('address'), b.get('name'), b.get('hash'),
+                             b.get('reason'), b.get('duration')) for b in add]
+            added, removed = get_ban_index(id, server).update(bans, remove)
+        except ValueError, e:
+            return jsonify(message=str(e)), 400
+        except Murmur.ServerBootedException:
+            return jsonify(message="Server not running."), 409
+
+        if required and not removed:
+            return jsonify(message="Ban not found."), 404
+
+        return jsonify(message="Bans updated.", added=added, removed=removed)
 
     def get_user(self, server, userid):
         # TODO: This is really non-scalable as the number of users on the server grows
@@ -738,13 +1049,72 @@ class StatsView(FlaskView):
             'users_online': get_all_users_count(meta),
             'murmur_version': meta.getVersion()[3],
             'murmur-rest_version': '0.1',
-            'uptime': meta.getUptime()
+            'uptime': meta.getUptime(),
+            'ice_hosts': breaker_states()
         }
 
         # Workaround response due to jsonify() not allowing top-level json response
         # https://github.com/mitsuhiko/flask/issues/170
         return Response(json.dumps(stats, sort_keys=True, indent=4), mimetype='application/json')
 
+    @conditional(auth.login_required, auth_enabled)
+    @route('history', methods=['GET'])
+    def history(self):
+        """
+        Users online and channel count over time, summed over all servers
+        """
+
+        try:
+            resolution = parse_resolution(request.args.get('resolution'))
+        except ValueError, e:
+            return jsonify(message=str(e)), 400
+
+        data = aggregate(resolution)
+        return Response(json.dumps(data, sort_keys=True, indent=4), mimetype='application/json')
+
+    @conditional(auth.login_required, auth_enabled)
+    @route('webhooks', methods=['GET'])
+    def webhook_stats(self):
+        """
+        Webhook delivery metrics of this process
+        """
+
+        if webhooks.dispatcher is None:
+            return jsonify(enabled=False)
+
+        return jsonify(enabled=True, **webhooks.dispatcher.stats())
+
+class UsersView(FlaskView):
+    """
+    View for finding online users across all servers.
+    """
+
+    @conditional(auth.login_required, auth_enabled)
+    @route('search', methods=['GET'])
+    def search(self):
+        """
+        Finds online users by name and/or address (IP or CIDR range)
+        """
+
+        name = request.args.get('name')
+        address = request.args.get('address')
+        partial = is_true(request.args.get('partial'))
+
+        if not (name or address):
+            return jsonify(message="Name or address required."), 400
+
+        try:
+            address = parse_cidr(address) if address else None
+        except ValueError, e:
+            return jsonify(message=str(e)), 400
+
+        user_index.refresh(meta)
+        data = user_index.search(name, address, partial)
+
+        # Workaround response due to jsonify() not allowing top-level json response
+        # https://github.com/mitsuhiko/flask/issues/170
+        return Response(json.dumps(data, sort_keys=True, indent=4), mimetype='application/json')
+
 class CVPView(FlaskView):
     """
     View for display CVP on servers where it is enabled.
@@ -753,7 +1123,7 @@ class CVPView(FlaskView):
     @support_jsonp
     @route('<int:id>', methods=['GET'])
     def cvp(self, id):
-        server = meta.getServer(id)
+        server = server_cache.get(id)
 
         # Return 404 if not found
         if server is None:
@@ -784,9 +1154,33 @@ class CVPView(FlaskView):
 
         return Response(json.dumps(cvp, sort_keys=True, indent=4), mimetype='application/json')
 
+@app.errorhandler(CircuitOpenError)
+def murmur_circuit_open(e):
+    """ Fail fast while Murmur is known to be unavailable.
+    """
+    response = jsonify(message="Murmur unavailable.")
+    response.status_code = 503
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+@app.errorhandler(Ice.ObjectNotExistException)
+def murmur_server_gone(e):
+    """ A cached server was deleted outside of the API.
+    """
+    server_cache.clear()
+    return jsonify(message="Not Found"), 404
+
+@app.errorhandler(Ice.TimeoutException)
+@app.errorhandler(Ice.SocketException)
+def murmur_unavailable(e):
+    """ Murmur timed out or could not be reached.
+    """
+    return jsonify(message="Murmur unavailable: %s" % type(e).__name__), 503
+
 # Register views
 ServersView.register(app)
 StatsView.register(app)
+UsersView.register(app)
 CVPView.register(app)
 
 if __name__ == '__main__':
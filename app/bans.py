@@ -0,0 +1,257 @@
+"""
+bans.py
+In-memory ban index with CIDR lookup and coalesced setBans writes.
+
+Murmur only offers getBans/setBans for the whole list. Lookups are answered
+from a per-process index of each server's list. Changes are queued; the next
+write re-reads getBans(), applies all queued changes and calls setBans once, so
+concurrent writers share a single write and bans added elsewhere in the
+meantime are kept. A failed write fails every change in it.
+
+:copyright: (C) 2014 by github.com/alfg.
+:license:   MIT, see README for more details.
+"""
+
+import socket
+import threading
+import time
+
+import settings
+
+import Murmur
+
+# Seconds before a server's ban list is re-read from Murmur.
+BAN_INDEX_TTL = getattr(settings, 'BAN_INDEX_TTL', 60)
+
+# IPv4 addresses are stored by Murmur as IPv4-mapped IPv6 (::ffff:a.b.c.d).
+V4_PREFIX = (0,) * 10 + (255, 255)
+
+
+def parse_cidr(value):
+    """
+    Parses "1.2.3.4", "1.2.3.0/24" or "2001:db8::/32" into (NetAddress, bits),
+    using Murmur's IPv6 representation. Raises ValueError if invalid.
+    """
+    address, _, bits = (value or '').strip().partition('/')
+    try:
+        if ':' in address:
+            packed = tuple(ord(c) for c in socket.inet_pton(socket.AF_INET6, address))
+            offset = 0
+        else:
+            packed = V4_PREFIX + tuple(ord(c) for c in socket.inet_pton(socket.AF_INET, address))
+            offset = 96
+    except (socket.error, UnicodeEncodeError):
+        raise ValueError("Invalid address: %s" % value)
+
+    try:
+        bits = int(bits) + offset if bits else 128
+    except ValueError:
+        raise ValueError("Invalid prefix length: %s" % value)
+    if not offset <= bits <= 128:
+        raise ValueError("Invalid prefix length: %s" % value)
+
+    return packed, bits
+
+
+def address_bytes(address):
+    """
+    Normalizes a NetAddress to a tuple of ints. Ice returns byte sequences as str.
+    """
+    if isinstance(address, str):
+        return tuple(map(ord, address))
+    return tuple(address)
+
+
+def format_address(address):
+    """
+    Formats a Murmur NetAddress as an IP address string.
+    """
+    return format_cidr(address, 128).rsplit('/', 1)[0]
+
+
+def format_cidr(address, bits):
+    """
+    Formats a Murmur NetAddress and prefix length as a CIDR string.
+    """
+    address = address_bytes(address)
+    if address[:12] == V4_PREFIX and bits >= 96:
+        return '%s/%d' % ('.'.join(str(b) for b in address[12:]), bits - 96)
+    packed = ''.join(chr(b) for b in address)
+    return '%s/%d' % (socket.inet_ntop(socket.AF_INET6, packed), bits)
+
+
+def network(address, bits):
+    """
+    Converts a NetAddress into an integer with host bits cleared.
+    """
+    value = 0
+    for b in address_bytes(address):
+        value = (value << 8) | b
+    return value >> (128 - bits) << (128 - bits) if bits else 0
+
+
+def ban_to_dict(ban):
+    """
+    Convert a Murmur.Ban to a dict, including its CIDR notation.
+    """
+    return {
+        "address": format_cidr(ban.address, ban.bits),
+        "name": ban.name,
+        "hash": ban.hash,
+        "reason": ban.reason,
+        "start": ban.start,
+        "duration": ban.duration
+    }
+
+
+def make_ban(cidr, name='', hash='', reason='', duration=0):
+    """
+    Builds a Murmur.Ban starting now from a CIDR string.
+    """
+    address, bits = parse_cidr(cidr)
+    ban = Murmur.Ban()
+    ban.address = address
+    ban.bits = bits
+    ban.name = name or ''
+    ban.hash = hash or ''
+    ban.reason = reason or ''
+    ban.start = int(time.time())
+    ban.duration = int(duration or 0)
+    return ban
+
+
+def ban_key(ban):
+    return (network(ban.address, ban.bits), ban.bits)
+
+
+def apply_change(bans, change):
+    """
+    Applies one update() change to a ban list, counting the bans it removed.
+    """
+    removed = set(change['remove'])
+    replaced = set((ban_key(b), b.name, b.hash) for b in change['add'])
+    kept = []
+    for ban in bans:
+        if ban_key(ban) in removed:
+            change['removed'] += 1
+        elif (ban_key(ban), ban.name, ban.hash) not in replaced:
+            kept.append(ban)
+    return kept + change['add']
+
+
+class BanIndex(object):
+    """
+    Ban list of a single server indexed by (network, bits), plus queued changes.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.bans = {}
+        self.loaded = 0
+        # Changes waiting for the next write
+        self.pending = []
+
+    def _index(self, bans):
+        # Caller holds self.lock. Bans differing only by name or hash are kept apart.
+        self.bans = {}
+        for ban in bans:
+            self.bans.setdefault(ban_key(ban), []).append(ban)
+        self.loaded = time.time()
+
+    def _load(self):
+        # Caller holds self.lock
+        if time.time() - self.loaded >= BAN_INDEX_TTL:
+            self._index(self.server.getBans())
+
+    def all(self):
+        with self.lock:
+            self._load()
+            return [ban for bans in self.bans.values() for ban in bans]
+
+    def update(self, add=(), remove=()):
+        """
+        Adds bans and removes CIDR ranges. Adding a ban replaces bans for the
+        same network with the same name and hash; removing a range removes
+        every ban for exactly that network. Returns (added, removed) where
+        removed counts the bans actually removed. If the write carrying the
+        change fails its error is raised here and the change is dropped.
+        """
+        change = {
+            'add': list(add),
+            'remove': [(network(a, b), b) for a, b in (parse_cidr(cidr) for cidr in remove)],
+            'removed': 0,
+            'error': None,
+        }
+        with self.lock:
+            self.pending.append(change)
+
+        self.flush()
+        if change['error'] is not None:
+            raise change['error']
+        return len(change['add']), change['removed']
+
+    def flush(self):
+        """
+        Applies all pending changes, in order, to a fresh getBans() and writes
+        the result with one setBans call. Callers waiting here while another
+        write is in flight usually find their change already written by it.
+        """
+        with self.write_lock:
+            with self.lock:
+                changes, self.pending = self.pending, []
+            if not changes:
+                return
+
+            try:
+                bans = self.server.getBans()
+                for change in changes:
+                    bans = apply_change(bans, change)
+                self.server.setBans(bans)
+            except Exception, e:
+                # Fail the whole batch; every caller in it gets the error
+                for change in changes:
+                    change['error'] = e
+                return
+
+            with self.lock:
+                self._index(bans)
+
+    def lookup(self, ip):
+        """
+        Returns the active bans covering an address.
+        """
+        address, bits = parse_cidr(ip)
+        now = time.time()
+        with self.lock:
+            self._load()
+            prefixes = set(b for n, b in self.bans)
+            matches = []
+            for b in prefixes:
+                matches.extend(self.bans.get((network(address, b), b), ()))
+        return [ban for ban in matches if not ban.duration or ban.start + ban.duration > now]
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_ban_index(server_id, server):
+    """
+    Gets (or creates) the ban index for a server.
+    """
+    with _indexes_lock:
+        index = _indexes.get(server_id)
+        if index is None:
+            index = _indexes[server_id] = BanIndex(server)
+        index.server = server
+        return index
+
+
+def forget_ban_index(server_id):
+    """
+    Drops the ban index of a deleted server.
+    """
+    with _indexes_lock:
+        _indexes.pop(server_id, None)
@@ -0,0 +1,221 @@
+"""
+events.py
+Murmur MetaCallback and ServerCallback registration, publishing events to
+in-process listeners.
+
+Listeners are called on Ice threads and must not block; anything slow should
+be handed off to a queue.
+
+Murmur forgets callbacks when it restarts or loses the connection, so they are
+re-registered periodically. `active` is only True while the last registration
+succeeded, and `attached_at` is when events may have started being missed
+before that; state built from events should not be trusted if older.
+
+:copyright: (C) 2014 by github.com/alfg.
+:license:   MIT, see README for more details.
+"""
+
+import logging
+import time
+
+import settings
+
+from app.fanout import server_id
+from app.utils import start_loop
+
+import Ice
+import Murmur
+
+# Endpoint of the object adapter receiving callbacks from Murmur. Empty disables callbacks.
+ICE_CALLBACK_ENDPOINT = getattr(settings, 'ICE_CALLBACK_ENDPOINT', 'tcp -h 127.0.0.1')
+
+# Seconds between callback re-registrations.
+ICE_CALLBACK_REFRESH = getattr(settings, 'ICE_CALLBACK_REFRESH', 60)
+
+LOOPBACK_HOSTS = ('localhost', '::1', '0:0:0:0:0:0:0:1')
+
+log = logging.getLogger(__name__)
+
+listeners = []
+
+# True while callbacks are registered with Murmur.
+active = False
+
+# Time callbacks were last (re)registered after a gap.
+attached_at = 0
+
+# Murmur uptime at the last registration, to notice restarts.
+_uptime = None
+
+# Callback proxies, reused so re-registering is a no-op for Murmur.
+_meta_callback = None
+_server_callbacks = {}
+
+
+def subscribe(listener):
+    """
+    Adds a listener called with every event dict. Usable as a decorator.
+    """
+    listeners.append(listener)
+    return listener
+
+
+def publish(event_type, sid, data=None):
+    """
+    Passes an event to all listeners. `data` is the Murmur object(s) involved.
+    """
+    event = {
+        'type': event_type,
+        'server_id': sid,
+        'timestamp': time.time(),
+        'data': data
+    }
+    for listener in listeners:
+        try:
+            listener(event)
+        except Exception:
+            log.exception("Event listener failed for %s", event_type)
+
+
+class ServerCallbackI(Murmur.ServerCallback):
+    """
+    Receives user and channel events of a single server.
+    """
+
+    def __init__(self, sid):
+        self.sid = sid
+
+    def userConnected(self, state, current=None):
+        publish('user_connected', self.sid, state)
+
+    def userDisconnected(self, state, current=None):
+        publish('user_disconnected', self.sid, state)
+
+    def userStateChanged(self, state, current=None):
+        publish('user_state_changed', self.sid, state)
+
+    def userTextMessage(self, state, message, current=None):
+        publish('user_text_message', self.sid, {'user': state, 'message': message})
+
+    def channelCreated(self, state, current=None):
+        publish('channel_created', self.sid, state)
+
+    def channelRemoved(self, state, current=None):
+        publish('channel_removed', self.sid, state)
+
+    def channelStateChanged(self, state, current=None):
+        publish('channel_state_changed', self.sid, state)
+
+
+class MetaCallbackI(Murmur.MetaCallback):
+    """
+    Receives server start and stop events, and attaches a ServerCallback to
+    servers as they start.
+    """
+
+    def __init__(self, adapter):
+        self.adapter = adapter
+
+    def started(self, server, current=None):
+        sid = server_id(server)
+        try:
+            attach_server(self.adapter, server, sid)
+        except Ice.Exception:
+            log.exception("Could not add callback to server %d", sid)
+        publish('server_started', sid)
+
+    def stopped(self, server, current=None):
+        # Murmur drops the server's callbacks when it stops
+        publish('server_stopped', server_id(server))
+
+
+def attach_server(adapter, server, sid=None):
+    """
+    Registers a ServerCallback on a running server.
+    """
+    sid = server_id(server) if sid is None else sid
+    callback = _server_callbacks.get(sid)
+    if callback is None:
+        servant = adapter.addWithUUID(ServerCallbackI(sid))
+        callback = _server_callbacks[sid] = Murmur.ServerCallbackPrx.uncheckedCast(servant)
+    server.addCallback(callback)
+
+
+def register(adapter, meta):
+    """
+    Registers the MetaCallback, and a ServerCallback on every booted server.
+    Murmur ignores callbacks that are already registered.
+    """
+    global _meta_callback
+
+    if _meta_callback is None:
+        servant = adapter.addWithUUID(MetaCallbackI(adapter))
+        _meta_callback = Murmur.MetaCallbackPrx.uncheckedCast(servant)
+    meta.addCallback(_meta_callback)
+
+    for server in meta.getBootedServers():
+        attach_server(adapter, server)
+
+
+def is_loopback(host):
+    return host in LOOPBACK_HOSTS or host.startswith('127.') or host.startswith('::ffff:127.')
+
+
+def unreachable(adapter, meta):
+    """
+    True if the adapter only listens on loopback while Murmur is on another host.
+    """
+    try:
+        remote = meta.ice_getConnection().getInfo().remoteAddress
+        hosts = [e.getInfo().host for e in adapter.getEndpoints()]
+    except (Ice.Exception, AttributeError):
+        return False
+    return not is_loopback(remote) and all(is_loopback(h) for h in hosts)
+
+
+def reregister(adapter, meta):
+    """
+    Registers callbacks again, noticing failures and Murmur restarts. Only
+    the first failure after a successful registration is raised.
+    """
+    global active, attached_at, _uptime
+
+    try:
+        uptime = meta.getUptime()
+        register(adapter, meta)
+    except Exception:
+        was_active, active = active, False
+        if was_active:
+            raise
+        return
+
+    if not active or _uptime is None or uptime < _uptime:
+        # Events may have been missed until now
+        attached_at = time.time()
+    active = True
+    _uptime = uptime
+
+
+def start_callbacks(ice, meta):
+    """
+    Creates the callback adapter and starts registering with Murmur and all
+    booted servers. Returns the adapter, or None if callbacks are disabled or
+    Murmur could not reach the adapter.
+    """
+    if not ICE_CALLBACK_ENDPOINT:
+        return None
+
+    try:
+        adapter = ice.createObjectAdapterWithEndpoints('Callback.Client', ICE_CALLBACK_ENDPOINT)
+        adapter.activate()
+    except Ice.Exception:
+        log.exception("Could not create the Murmur callback adapter")
+        return None
+
+    if unreachable(adapter, meta):
+        log.warning("ICE_CALLBACK_ENDPOINT %r only listens on loopback but Murmur is remote; "
+                    "callbacks disabled", ICE_CALLBACK_ENDPOINT)
+        return None
+
+    start_loop('ice-callbacks', ICE_CALLBACK_REFRESH, reregister, adapter, meta)
+    return adapter
@@ -0,0 +1,142 @@
+"""
+fanout.py
+Helpers for running Ice calls against many servers concurrently.
+
+:copyright: (C) 2014 by github.com/alfg.
+:license:   MIT, see README for more details.
+"""
+
+from collections import deque
+
+import settings
+
+import Ice
+
+from app.resilience import CircuitOpenError
+
+# Per-call errors recorded by pipeline() instead of being raised.
+CALL_ERRORS = (Ice.Exception, CircuitOpenError)
+
+# Maximum number of asynchronous Ice calls in flight for a single fan-out.
+FANOUT_LIMIT = getattr(settings, 'FANOUT_LIMIT', 32)
+
+
+def pipeline(calls, limit=None):
+    """
+    Issues Ice calls asynchronously, keeping at most `limit` of them in flight.
+
+    `calls` is an iterable of (key, proxy, operation, args) tuples. Each call is
+    started with `proxy.begin_<operation>(*args)` and collected with
+    `proxy.end_<operation>()`. Returns a list of (key, result, error) tuples in
+    submission order; error is the Ice exception (or CircuitOpenError) raised,
+    or None on success.
+    """
+    limit = limit or FANOUT_LIMIT
+    pending = deque()
+    results = []
+
+    def collect():
+        key, prx, op, r = pending.popleft()
+        if isinstance(r, CALL_ERRORS):
+            results.append((key, None, r))
+            return
+        try:
+            results.append((key, getattr(prx, 'end_' + op)(r), None))
+        except CALL_ERRORS, e:
+            results.append((key, None, e))
+
+    for key, prx, op, args in calls:
+        if len(pending) >= limit:
+            collect()
+        try:
+            r = getattr(prx, 'begin_' + op)(*args)
+        except CALL_ERRORS, e:
+            r = e
+        pending.append((key, prx, op, r))
+
+    while pending:
+        collect()
+    return results
+
+
+def error_name(error):
+    """
+    Short, JSON-friendly description of an Ice exception.
+    """
+    return type(error).__name__
+
+
+def server_id(server):
+    """
+    Gets a server id from its proxy identity (category "s", name "<id>")
+    without a round trip.
+    """
+    identity = server.ice_getIdentity()
+    if identity.category == 's':
+        try:
+            return int(identity.name)
+        except ValueError:
+            pass
+    return server.id()
+
+
+def parse_ids(value):
+    """
+    Parses a comma separated list of ids, e.g. "1,2,3".
+    """
+    if not value:
+        return []
+    return [int(i) for i in value.split(',') if i.strip()]
+
+
+def default_value(defaults, key, sid):
+    """
+    The value a server uses for an unset key. Murmur gives server N the
+    default port + N - 1 rather than the default port itself.
+    """
+    value = defaults.get(key, '')
+    if key == 'port' and value:
+        return str(int(value) + sid - 1)
+    return value
+
+
+def select_servers(meta, args):
+    """
+    Resolves a server selector into (targets, failed): a list of (id, proxy)
+    tuples, and result dicts {'id': ..., 'status': ...} for requested ids that
+    could not be resolved, with status 'Not Found' or the Ice error.
+
+    Selectors, in order of precedence:
+        id=1,2,3                  the given server ids
+        conf_key=k&conf_value=v   booted servers whose config `k` equals `v`
+        servers=all               every server, booted or not
+        (default)                 every booted server
+    """
+    ids = parse_ids(args.get('id'))
+    if ids:
+        targets, failed = [], []
+        for i, s, error in pipeline((i, meta, 'getServer', (i,)) for i in ids):
+            if error is not None:
+                failed.append({'id': i, 'status': error_name(error)})
+            elif s is None:
+                failed.append({'id': i, 'status': 'Not Found'})
+            else:
+                targets.append((i, s))
+        return targets, failed
+
+    if args.get('servers') == 'all':
+        servers = meta.getAllServers()
+    else:
+        servers = meta.getBootedServers()
+    targets = [(server_id(s), s) for s in servers]
+
+    key = args.get('conf_key')
+    if key:
+        value = args.get('conf_value', '')
+        defaults = meta.getDefaultConf()
+        proxies = dict(targets)
+        confs = pipeline((i, s, 'getConf', (key,)) for i, s in targets)
+        targets = [(i, proxies[i]) for i, val, error in confs
+                   if error is None and (val or default_value(defaults, key, i)) == value]
+
+    return targets, []
@@ -0,0 +1,229 @@
+"""
+history.py
+Occupancy time series stored in memory-mapped ring buffers.
+
+Each server gets one fixed-size file holding a ring buffer per resolution.
+A slot records the bucket number, the sum and maximum of users online, the
+number of samples and the channel count, so coarser resolutions are
+downsampled as samples arrive and no separate rollup pass is needed.
+
+:copyright: (C) 2014 by github.com/alfg.
+:license:   MIT, see README for more details.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+
+import settings
+
+from app.fanout import pipeline, server_id
+from app.utils import hold_lock_file, start_loop
+
+# Directory holding one history file per server.
+HISTORY_PATH = getattr(settings, 'HISTORY_PATH', os.path.join(settings.MURMUR_ROOT, 'history'))
+
+# Seconds between samples. 0 disables the sampler.
+HISTORY_INTERVAL = getattr(settings, 'HISTORY_INTERVAL', 10)
+
+# Only the worker process holding this lock samples.
+HISTORY_LOCK_FILE = getattr(settings, 'HISTORY_LOCK_FILE', os.path.join(settings.MURMUR_ROOT, '.history.lock'))
+
+# (name, seconds per bucket, number of buckets kept)
+RESOLUTIONS = (
+    ('10s', 10, 360),     # 1 hour
+    ('1m', 60, 1440),     # 1 day
+    ('1h', 3600, 720),    # 30 days
+)
+
+# bucket, users sum, users max, samples, channels
+SLOT = struct.Struct('<5I')
+
+class History(object):
+    """
+    Memory-mapped ring buffers of a single server.
+    """
+
+    size = SLOT.size * sum(slots for name, step, slots in RESOLUTIONS)
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a+b')
+        if os.fstat(self.file.fileno()).st_size != self.size:
+            # New file, or written with a different layout
+            self.file.truncate(0)
+            self.file.truncate(self.size)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+
+        self.offsets = {}
+        offset = 0
+        for name, step, slots in RESOLUTIONS:
+            self.offsets[name] = offset
+            offset += SLOT.size * slots
+
+    def current(self):
+        """
+        False if the file was deleted or replaced since it was opened.
+        """
+        try:
+            return os.stat(self.path).st_ino == os.fstat(self.file.fileno()).st_ino
+        except OSError:
+            return False
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def record(self, now, users, channels):
+        """
+        Adds a sample to every resolution.
+        """
+        # Worker processes may share the file
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            for name, step, slots in RESOLUTIONS:
+                bucket = int(now) // step
+                pos = self.offsets[name] + SLOT.size * (bucket % slots)
+                b, total, peak, count, chans = SLOT.unpack_from(self.map, pos)
+                if b != bucket:
+                    total = peak = count = chans = 0
+                SLOT.pack_into(self.map, pos, bucket, total + users,
+                               max(peak, users), count + 1, max(chans, channels))
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def series(self, resolution, now=None):
+        """
+        Returns the recorded buckets of a resolution, oldest first.
+        """
+        step, slots = dict((n, (st, sl)) for n, st, sl in RESOLUTIONS)[resolution]
+        current = int(now or time.time()) // step
+        points = []
+        for bucket in xrange(current - slots + 1, current + 1):
+            pos = self.offsets[resolution] + SLOT.size * (bucket % slots)
+            b, total, peak, count, chans = SLOT.unpack_from(self.map, pos)
+            if b == bucket and count:
+                points.append({
+                    'timestamp': bucket * step,
+                    'users': float(total) / count,
+                    'users_max': peak,
+                    'channels': chans
+                })
+        return points
+
+
+_histories = {}
+_histories_lock = threading.Lock()
+
+
+def history_path(server_id):
+    return os.path.join(HISTORY_PATH, 'server-%d.bin' % server_id)
+
+
+def get_history(server_id, create=False):
+    """
+    Gets the history of a server, or None if nothing was recorded for it.
+    """
+    path = history_path(server_id)
+    with _histories_lock:
+        history = _histories.get(server_id)
+        if history is not None and not history.current():
+            # Deleted with its server, possibly by another worker process
+            history.close()
+            del _histories[server_id]
+            history = None
+        if history is None:
+            if not create and not os.path.exists(path):
+                return None
+            if not os.path.isdir(HISTORY_PATH):
+                os.makedirs(HISTORY_PATH)
+            history = _histories[server_id] = History(path)
+        return history
+
+
+def forget_history(server_id):
+    """
+    Deletes the history of a deleted server, so a new server reusing its id
+    starts empty.
+    """
+    with _histories_lock:
+        history = _histories.pop(server_id, None)
+        if history is not None:
+            history.close()
+        try:
+            os.remove(history_path(server_id))
+        except OSError:
+            pass
+
+
+def parse_resolution(value):
+    """
+    Validates a resolution name, defaulting to the finest. Raises ValueError.
+    """
+    names = [name for name, step, slots in RESOLUTIONS]
+    if not value:
+        return names[0]
+    if value not in names:
+        raise ValueError("Resolution must be one of: %s." % ', '.join(names))
+    return value
+
+
+def server_ids():
+    """
+    Ids of all servers with recorded history.
+    """
+    if not os.path.isdir(HISTORY_PATH):
+        return []
+    return sorted(int(f[7:-4]) for f in os.listdir(HISTORY_PATH)
+                  if f.startswith('server-') and f.endswith('.bin'))
+
+
+def aggregate(resolution, now=None):
+    """
+    Sums the series of all servers per bucket. Per-server peaks may occur at
+    different times within a bucket, so their sum is reported as users_max_sum,
+    an upper bound of the fleet-wide peak.
+    """
+    buckets = {}
+    for sid in server_ids():
+        for point in get_history(sid).series(resolution, now):
+            total = buckets.setdefault(point['timestamp'], {
+                'timestamp': point['timestamp'], 'users': 0.0, 'users_max_sum': 0, 'channels': 0, 'servers': 0
+            })
+            total['users'] += point['users']
+            total['users_max_sum'] += point['users_max']
+            total['channels'] += point['channels']
+            total['servers'] += 1
+    return [buckets[t] for t in sorted(buckets)]
+
+
+def sample(meta):
+    """
+    Records users online and channel count of every booted server.
+    """
+    now = time.time()
+    servers = [(server_id(s), s) for s in meta.getBootedServers()]
+    users = dict((sid, len(u)) for sid, u, error in
+                 pipeline((sid, s, 'getUsers', ()) for sid, s in servers) if error is None)
+    channels = dict((sid, len(c)) for sid, c, error in
+                    pipeline((sid, s, 'getChannels', ()) for sid, s in servers) if error is None)
+
+    for sid in users:
+        get_history(sid, create=True).record(now, users[sid], channels.get(sid, 0))
+
+
+def start_sampler(meta):
+    """
+    Starts the background sampling thread, if enabled.
+    """
+    if not HISTORY_INTERVAL:
+        return None
+
+    if not hold_lock_file(HISTORY_LOCK_FILE):
+        # Another worker process is sampling
+        return None
+
+    return start_loop('history-sampler', HISTORY_INTERVAL, sample, meta)
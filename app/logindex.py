@@ -0,0 +1,204 @@
+"""
+logindex.py
+Incremental ingestion of server logs into local SQLite full-text indexes.
+
+A background thread tails each booted server's log with growing getLog()
+windows from the most recent entry back to the last ingested timestamp, so
+searching logs does not require downloading them from Murmur.
+
+:copyright: (C) 2014 by github.com/alfg.
+:license:   MIT, see README for more details.
+"""
+
+import os
+import sqlite3
+from collections import Counter
+
+import settings
+
+from app import fanout
+from app.utils import hold_lock_file, start_loop
+
+import Ice
+
+# Directory holding one SQLite index per server.
+LOG_INDEX_PATH = getattr(settings, 'LOG_INDEX_PATH', os.path.join(settings.MURMUR_ROOT, 'logindex'))
+
+# Seconds between ingestion passes. 0 disables the background ingester.
+LOG_INGEST_INTERVAL = getattr(settings, 'LOG_INGEST_INTERVAL', 30)
+
+# Only the worker process holding this lock ingests.
+LOG_INDEX_LOCK_FILE = getattr(settings, 'LOG_INDEX_LOCK_FILE', os.path.join(settings.MURMUR_ROOT, '.logindex.lock'))
+
+# Number of log entries fetched by the first getLog call of a pass, doubling
+# up to LOG_WINDOW until entries that were already ingested are reached.
+LOG_PROBE = 10
+LOG_WINDOW = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (id INTEGER PRIMARY KEY, timestamp INTEGER, txt TEXT);
+CREATE INDEX IF NOT EXISTS entries_timestamp ON entries (timestamp);
+CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INTEGER);
+"""
+
+FTS_SCHEMA = "CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts4(content='entries', txt)"
+
+
+def index_path(server_id):
+    return os.path.join(LOG_INDEX_PATH, 'server-%d.db' % server_id)
+
+
+def connect(server_id, create=False):
+    """
+    Opens the log index of a server. Returns (connection, has_fts), or
+    (None, False) if the index does not exist and create is False.
+    """
+    path = index_path(server_id)
+    if not create and not os.path.exists(path):
+        return None, False
+    if create and not os.path.isdir(LOG_INDEX_PATH):
+        os.makedirs(LOG_INDEX_PATH)
+
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.executescript(SCHEMA)
+    try:
+        conn.execute(FTS_SCHEMA)
+        has_fts = True
+    except sqlite3.OperationalError:
+        # SQLite built without FTS4, search falls back to LIKE.
+        has_fts = False
+    return conn, has_fts
+
+
+def ingest(server_id, server):
+    """
+    Ingests log entries added since the last pass. Murmur numbers entries from
+    the most recent (0), so getLog(first, count) windows are read from 0 until
+    they reach entries older than the last ingested timestamp; the first window
+    is small so an idle server costs a single short call. Counting from the old
+    log length would miss entries once Murmur prunes old ones.
+
+    Entries at the last ingested timestamp may have been partly ingested, so
+    only as many copies of each message as exceed the stored ones are added.
+    Returns the number of entries added.
+    """
+    conn, has_fts = connect(server_id, create=True)
+    try:
+        # Serializes ingestion of a server across threads and worker processes
+        conn.execute('BEGIN IMMEDIATE')
+        state = dict(conn.execute('SELECT key, value FROM state'))
+        last_ts = state.get('last_ts', 0)
+
+        entries = []
+        boundary = Counter()
+        first, count = 0, LOG_PROBE
+        while True:
+            window = server.getLog(first, count)
+            for entry in window:
+                if entry.timestamp > last_ts:
+                    entries.append((entry.timestamp, entry.txt))
+                elif entry.timestamp == last_ts:
+                    boundary[entry.txt] += 1
+            if len(window) < count or window[-1].timestamp < last_ts:
+                # Reached the end of the log or entries already ingested
+                break
+            first += count
+            count = min(count * 2, LOG_WINDOW)
+
+        stored = Counter(row[0] for row in conn.execute(
+            'SELECT txt FROM entries WHERE timestamp = ?', (last_ts,)))
+        for txt, n in boundary.iteritems():
+            entries.extend([(last_ts, txt)] * (n - stored[txt]))
+
+        # Oldest first; the log lists the most recent entry first
+        entries.reverse()
+        entries.sort(key=lambda e: e[0])
+        for timestamp, txt in entries:
+            rowid = conn.execute('INSERT INTO entries (timestamp, txt) VALUES (?, ?)',
+                                 (timestamp, txt)).lastrowid
+            if has_fts:
+                conn.execute('INSERT INTO entries_fts (docid, txt) VALUES (?, ?)', (rowid, txt))
+
+        if entries:
+            last_ts = max(last_ts, entries[-1][0])
+        conn.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', ('last_ts', last_ts))
+        conn.execute('COMMIT')
+        return len(entries)
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+
+def forget_index(server_id):
+    """
+    Deletes the log index of a deleted server, so a new server reusing its id
+    starts empty.
+    """
+    path = index_path(server_id)
+    for name in (path, path + '-journal'):
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+
+
+def search(server_id, query=None, since=None, limit=100):
+    """
+    Searches a server's log index, most recent entries first. Returns None if
+    the server has no index yet.
+    """
+    conn, has_fts = connect(server_id)
+    if conn is None:
+        return None
+
+    try:
+        sql = 'SELECT e.timestamp, e.txt FROM entries e'
+        where = []
+        args = []
+        if query and has_fts:
+            sql += ' JOIN entries_fts f ON f.docid = e.id'
+            where.append('f.txt MATCH ?')
+            args.append(query)
+        elif query:
+            where.append('e.txt LIKE ?')
+            args.append('%' + query + '%')
+        if since:
+            where.append('e.timestamp >= ?')
+            args.append(since)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY e.timestamp DESC, e.id DESC LIMIT ?'
+        args.append(limit)
+
+        return [{"message": txt, "timestamp": timestamp}
+                for timestamp, txt in conn.execute(sql, args)]
+    finally:
+        conn.close()
+
+
+def ingest_all(meta):
+    """
+    Runs one ingestion pass over all booted servers.
+    """
+    for server in meta.getBootedServers():
+        try:
+            ingest(fanout.server_id(server), server)
+        except (Ice.Exception, sqlite3.Error):
+            # Try again on the next pass
+            continue
+
+
+def start_log_ingester(meta):
+    """
+    Starts the background ingestion thread, if enabled.
+    """
+    if not LOG_INGEST_INTERVAL:
+        return None
+
+    if not hold_lock_file(LOG_INDEX_LOCK_FILE):
+        # Another worker process is ingesting
+        return None
+
+    return start_loop('log-ingester', LOG_INGEST_INTERVAL, ingest_all, meta)
@@ -0,0 +1,73 @@
+"""
+moderation.py
+Functions for moderating many users on a server at once.
+
+:copyright: (C) 2014 by github.com/alfg.
+:license:   MIT, see README for more details.
+"""
+
+from app.fanout import pipeline, error_name
+
+ACTIONS = ('mute', 'unmute', 'kick', 'move')
+
+
+def resolve_targets(users, sessions=(), userids=(), channel=None):
+    """
+    Resolves sessions, registered user ids and a channel against a single
+    getUsers() snapshot. Returns (matched users, unresolved targets).
+    """
+    by_userid = {}
+    for u in users.values():
+        if u.userid >= 0:
+            by_userid.setdefault(u.userid, []).append(u)
+
+    matched = {}
+    missing = []
+
+    for session in sessions:
+        if session in users:
+            matched[session] = users[session]
+        else:
+            missing.append({'session': session, 'status': 'Not Found'})
+
+    for userid in userids:
+        found = by_userid.get(userid)
+        if not found:
+            missing.append({'userid': userid, 'status': 'Not Found'})
+        for u in found or ():
+            matched[u.session] = u
+
+    if channel is not None:
+        for u in users.values():
+            if u.channel == channel:
+                matched[u.session] = u
+
+    return [matched[s] for s in sorted(matched)], missing
+
+
+def moderate(server, users, action, reason=None, target_channel=None):
+    """
+    Applies a moderation action to every user, pipelining the Ice calls.
+    Users are modified in place from the snapshot, so no getState is needed.
+    """
+    calls = []
+    for u in users:
+        if action == 'kick':
+            calls.append((u, server, 'kickUser', (u.session, reason)))
+            continue
+
+        if action == 'move':
+            u.channel = target_channel
+        else:
+            u.mute = u.suppress = (action == 'mute')
+        calls.append((u, server, 'setState', (u,)))
+
+    results = []
+    for u, _, error in pipeline(calls):
+        results.append({
+            'session': u.session,
+            'userid': u.userid,
+            'name': u.name,
+            'status': 'Success' if error is None else error_name(error)
+        })
+    return results
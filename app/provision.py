@@ -0,0 +1,96 @@
+"""
+provision.py
+Template-based creation of many servers at once.
+
+:copyright: (C) 2014 by github.com/alfg.
+:license:   MIT, see README for more details.
+"""
+
+import threading
+
+import settings
+
+from app.fanout import pipeline, server_id, error_name
+
+# Named sets of configuration applied to new servers.
+SERVER_TEMPLATES = getattr(settings, 'SERVER_TEMPLATES', {'default': {}})
+
+# Configuration form fields accepted when creating servers.
+CONF_KEYS = ('password', 'timeout', 'bandwidth', 'users', 'welcometext',
+             'registername', 'registerpassword', 'registerhostname', 'registerurl')
+
+# Maximum number of servers created by a single request.
+BULK_CREATE_LIMIT = getattr(settings, 'BULK_CREATE_LIMIT', 500)
+
+MAX_PORT = 65535
+
+# Held from reading the used ports until the new servers' ports are set, so
+# concurrent requests don't pick the same ports.
+_provision_lock = threading.Lock()
+
+
+def used_ports(meta, defaults):
+    """
+    Gets the ports of all existing servers, including those on the default
+    port (base port + id - 1).
+    """
+    base = int(defaults.get('port', 64738))
+    servers = [(server_id(s), s) for s in meta.getAllServers()]
+    ports = set()
+    for sid, port, error in pipeline((sid, s, 'getConf', ('port',)) for sid, s in servers):
+        ports.add(int(port) if port else base + sid - 1)
+    return ports
+
+
+def allocate_ports(count, used, start):
+    """
+    Picks `count` free ports from `start` upwards. Raises ValueError if there
+    are not enough ports left below 65536.
+    """
+    ports = []
+    port = start
+    while len(ports) < count:
+        if port > MAX_PORT:
+            raise ValueError("Not enough free ports from %d." % start)
+        if port not in used:
+            ports.append(port)
+        port += 1
+    return ports
+
+
+def provision(meta, count, conf, start_port=None, start=True, cache=None):
+    """
+    Creates `count` servers with non-conflicting ports, applies `conf` to each
+    and optionally starts them, pipelining the calls across servers. New
+    servers are added to `cache` (a ServerCache), if given. Returns a compact
+    list of result dicts. Raises ValueError if the ports run out.
+    """
+    with _provision_lock:
+        defaults = meta.getDefaultConf()
+        used = used_ports(meta, defaults)
+        ports = allocate_ports(count, used, int(start_port or defaults.get('port', 64738)))
+
+        created = [s for i, s, error in pipeline((i, meta, 'newServer', ()) for i in xrange(count))
+                   if error is None]
+        servers = [(server_id(s), s, port) for s, port in zip(created, ports)]
+        if cache is not None:
+            for sid, s, port in servers:
+                cache.add(sid, s)
+        proxies = dict((sid, s) for sid, s, port in servers)
+        results = dict((sid, {'id': sid, 'port': port, 'status': 'Created'}) for sid, s, port in servers)
+
+        calls = []
+        for sid, s, port in servers:
+            values = dict(conf, port=str(port))
+            calls.extend((sid, s, 'setConf', (key, value)) for key, value in values.iteritems())
+        for sid, _, error in pipeline(calls):
+            if error is not None:
+                results[sid]['status'] = error_name(error)
+
+    if start:
+        ok = [sid for sid in sorted(results) if results[sid]['status'] == 'Created']
+        for sid, _, error in pipeline((sid, proxies[sid], 'start', ()) for sid in ok):
+            results[sid]['status'] = 'Started' if error is None else error_name(error)
+
+    failed = count - len(created)
+    return [results[sid] for sid in sorted(results)] + [{'status': 'Failed'}] * failed
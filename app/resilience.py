@@ -0,0 +1,233 @@
+"""
+resilience.py
+Invocation timeouts, a circuit breaker per Murmur host and hedged calls for
+idempotent read operations.
+
+Proxies are wrapped in a GuardedProxy, which applies per-operation timeouts,
+fails fast with CircuitOpenError while the host's breaker is open, and wraps
+proxies returned by Murmur (getServer, getAllServers, ...) the same way.
+
+:copyright: (C) 2014 by github.com/alfg.
+:license:   MIT, see README for more details.
+"""
+
+import os
+import re
+import threading
+import time
+
+import settings
+
+import Ice
+
+# Default invocation timeout in milliseconds, and overrides per operation.
+ICE_TIMEOUT = getattr(settings, 'ICE_TIMEOUT', 10000)
+ICE_OPERATION_TIMEOUTS = getattr(settings, 'ICE_OPERATION_TIMEOUTS', {'getLog': 30000})
+
+# Milliseconds to wait before sending a second copy of an idempotent read. 0 disables hedging.
+ICE_HEDGE_DELAY = getattr(settings, 'ICE_HEDGE_DELAY', 0)
+
+# Consecutive failures before the breaker opens, and seconds before a trial call is let through.
+CIRCUIT_FAILURE_THRESHOLD = getattr(settings, 'CIRCUIT_FAILURE_THRESHOLD', 5)
+CIRCUIT_RESET_TIMEOUT = getattr(settings, 'CIRCUIT_RESET_TIMEOUT', 30)
+
+# Errors meaning the host is unreachable or hung, as opposed to e.g. an invalid session.
+HOST_FAILURES = (Ice.TimeoutException, Ice.SocketException)
+
+
+def idempotent_operations(path):
+    """
+    Reads the names of operations marked idempotent from a slice file.
+    """
+    with open(path) as f:
+        return frozenset(re.findall(r'\bidempotent\s+[\w:]+[\s*]+(\w+)\s*\(', f.read()))
+
+IDEMPOTENT = idempotent_operations(os.path.join(settings.MURMUR_ROOT, settings.SLICE_FILE))
+
+# Only reads are hedged; idempotent writes are safe to repeat but not worth duplicating.
+HEDGED = frozenset(op for op in IDEMPOTENT if op.startswith(('get', 'is', 'id')))
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a Murmur host whose breaker is open.
+    """
+
+    def __init__(self, host, retry_after):
+        Exception.__init__(self, "Murmur host %s unavailable" % host)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """
+    Opens after consecutive host failures; once the reset timeout passes, one
+    trial call is let through and its outcome closes or reopens the breaker.
+    A trial whose outcome is never reported (e.g. begin_ without end_) expires
+    after another reset timeout, so the breaker cannot get stuck half-open.
+    """
+
+    def __init__(self, host, threshold, reset_timeout):
+        self.host = host
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.trial_started = 0
+        self.lock = threading.Lock()
+
+    def check(self):
+        with self.lock:
+            if self.opened is None:
+                return
+            now = time.time()
+            retry_after = self.opened + self.reset_timeout - now
+            if self.trial:
+                retry_after = self.trial_started + self.reset_timeout - now
+            if retry_after > 0:
+                raise CircuitOpenError(self.host, max(int(retry_after), 1))
+            self.trial = True
+            self.trial_started = now
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                self.opened = time.time()
+            self.trial = False
+
+    def state(self):
+        with self.lock:
+            if self.opened is None:
+                return 'closed'
+            return 'half-open' if self.trial else 'open'
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(prx):
+    """
+    Gets the circuit breaker of the host a proxy points to.
+    """
+    host = ':'.join(str(e) for e in prx.ice_getEndpoints())
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(host, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+        return breaker
+
+
+def breaker_states():
+    with _breakers_lock:
+        return dict((host, b.state()) for host, b in _breakers.items())
+
+
+def wrap(value):
+    """
+    Wraps proxies, and lists of proxies, returned by Murmur.
+    """
+    if isinstance(value, Ice.ObjectPrx):
+        return GuardedProxy(value)
+    if isinstance(value, list) and value and isinstance(value[0], Ice.ObjectPrx):
+        return [GuardedProxy(v) for v in value]
+    return value
+
+
+class GuardedProxy(object):
+    """
+    Proxy wrapper applying timeouts, the circuit breaker and hedging.
+    begin_/end_ calls are supported so pipelined calls are guarded as well.
+    """
+
+    def __init__(self, prx, breaker=None):
+        self._prx = prx
+        self._breaker = breaker or get_breaker(prx)
+        self._timed = {}
+
+    def _proxy(self, op):
+        # end_<op> must be called on the very proxy object begin_<op> used
+        timeout = ICE_OPERATION_TIMEOUTS.get(op, ICE_TIMEOUT)
+        prx = self._timed.get(timeout)
+        if prx is None:
+            prx = self._timed[timeout] = self._prx.ice_timeout(timeout) if timeout else self._prx
+        return prx
+
+    def _guard(self, call, *args, **kwargs):
+        self._breaker.check()
+        return self._record(call, *args, **kwargs)
+
+    def _record(self, call, *args, **kwargs):
+        # Reports the outcome of a call to the breaker, without checking it
+        try:
+            result = call(*args, **kwargs)
+        except HOST_FAILURES:
+            self._breaker.failure()
+            raise
+        except Exception:
+            # Any other error still means the host answered
+            self._breaker.success()
+            raise
+        self._breaker.success()
+        return wrap(result)
+
+    def __getattr__(self, name):
+        if name.startswith('ice_'):
+            return getattr(self._prx, name)
+
+        if name.startswith('begin_'):
+            begin = getattr(self._proxy(name[6:]), name)
+            def guarded_begin(*args, **kwargs):
+                self._breaker.check()
+                return begin(*args, **kwargs)
+            return guarded_begin
+
+        if name.startswith('end_'):
+            # The breaker was checked by begin_; this completes a possible trial
+            return lambda r: self._record(getattr(self._proxy(name[4:]), name), r)
+
+        if ICE_HEDGE_DELAY and name in HEDGED:
+            return lambda *args: self._guard(self._hedged, name, args)
+
+        return lambda *args: self._guard(getattr(self._proxy(name), name), *args)
+
+    def _hedged(self, op, args):
+        """
+        Starts the call, and a second copy if no reply arrived within the hedge
+        delay. Returns the first successful reply, or raises the first error.
+        """
+        begin = getattr(self._proxy(op), 'begin_' + op)
+        done = threading.Condition(threading.RLock())
+        outcomes = []
+
+        def response(*result):
+            with done:
+                outcomes.append((True, result))
+                done.notify()
+
+        def exception(ex):
+            with done:
+                outcomes.append((False, ex))
+                done.notify()
+
+        with done:
+            begin(*args, _response=response, _ex=exception)
+            done.wait(ICE_HEDGE_DELAY / 1000.0)
+            attempts = 1
+            if not any(ok for ok, result in outcomes):
+                begin(*args, _response=response, _ex=exception)
+                attempts = 2
+            while not any(ok for ok, result in outcomes) and len(outcomes) < attempts:
+                done.wait()
+
+        for ok, result in outcomes:
+            if ok:
+                return result[0] if len(result) == 1 else (result or None)
+        raise outcomes[0][1]
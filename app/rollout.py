@@ -0,0 +1,67 @@
+"""
+rollout.py
+Functions for rolling out configuration changes to many servers.
+
+:copyright: (C) 2014 by github.com/alfg.
+:license:   MIT, see README for more details.
+"""
+
+from app.fanout import FANOUT_LIMIT, default_value, pipeline, error_name
+
+# Form fields used for server selection and options rather than configuration.
+RESERVED_KEYS = ('id', 'servers', 'conf_key', 'conf_value', 'dry_run', 'stream')
+
+
+def conf_diff(current, defaults, patch, sid):
+    """
+    Computes the keys of a config patch that differ from the server's current
+    configuration. Returns a dict of key -> {'old': ..., 'new': ...}.
+    """
+    diff = {}
+    for key, value in patch.iteritems():
+        old = current.get(key) or default_value(defaults, key, sid)
+        if old != value:
+            diff[key] = {'old': old, 'new': value}
+    return diff
+
+
+def rollout(meta, targets, patch, dry_run=False, chunk_size=None):
+    """
+    Applies a config patch to many (server id, server) targets, only writing
+    keys that changed. Servers are processed in chunks with pipelined calls;
+    yields (results, done, total) after each chunk so callers can report progress.
+    """
+    targets = list(targets)
+    chunk_size = chunk_size or FANOUT_LIMIT
+    defaults = meta.getDefaultConf()
+    done = 0
+
+    for offset in xrange(0, len(targets), chunk_size):
+        chunk = targets[offset:offset + chunk_size]
+        proxies = dict(chunk)
+        results = {}
+        writes = []
+
+        for sid, current, error in pipeline((sid, s, 'getAllConf', ()) for sid, s in chunk):
+            if error is not None:
+                results[sid] = {'id': sid, 'status': error_name(error)}
+                continue
+
+            diff = conf_diff(current, defaults, patch, sid)
+            if not diff:
+                status = 'Unchanged'
+            elif dry_run:
+                status = 'Dry Run'
+            else:
+                status = 'Updated'
+                writes.extend(((sid, key), proxies[sid], 'setConf', (key, change['new']))
+                              for key, change in diff.iteritems())
+            results[sid] = {'id': sid, 'changes': diff, 'status': status}
+
+        for (sid, key), _, error in pipeline(writes):
+            if error is not None:
+                results[sid]['status'] = error_name(error)
+                results[sid]['changes'][key]['error'] = error_name(error)
+
+        done += len(chunk)
+        yield [results[sid] for sid, s in chunk], done, len(targets)
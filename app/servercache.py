@@ -0,0 +1,81 @@
+"""
+servercache.py
+Cache of server proxies by id, so requests don't need a getServer round trip.
+
+The cache is filled from a single getAllServers() call, since proxy identities
+carry the server id. Servers created or deleted through the API update it
+directly, and Murmur start/stop events evict the server concerned. A
+background thread reloads it periodically; requests never wait for a reload,
+and cache misses fall back to a live getServer lookup.
+
+:copyright: (C) 2014 by github.com/alfg.
+:license:   MIT, see README for more details.
+"""
+
+import threading
+import time
+
+import settings
+
+from app import events
+from app.fanout import server_id
+from app.utils import start_loop
+
+# Seconds before the cache is reloaded, to notice servers deleted outside the API.
+SERVER_CACHE_TTL = getattr(settings, 'SERVER_CACHE_TTL', 300)
+
+
+
+class ServerCache(object):
+    """
+    Maps server ids to Murmur.ServerPrx proxies.
+    """
+
+    def __init__(self, meta):
+        self.meta = meta
+        self.servers = {}
+        self.loaded = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        servers = dict((server_id(s), s) for s in self.meta.getAllServers())
+        with self.lock:
+            self.servers = servers
+            self.loaded = time.time()
+
+    def start(self):
+        """
+        Starts the background reload thread. While reloads fail, cache misses
+        still fall back to getServer.
+        """
+        return start_loop('server-cache', SERVER_CACHE_TTL, self.load)
+
+    def get(self, id):
+        """
+        Gets a server proxy, or None if the server does not exist.
+        """
+        server = self.servers.get(id)
+        if server is None:
+            server = self.meta.getServer(id)
+            if server is not None:
+                self.add(id, server)
+        return server
+
+    def add(self, id, server):
+        with self.lock:
+            self.servers[id] = server
+
+    def discard(self, id):
+        with self.lock:
+            self.servers.pop(id, None)
+
+    def clear(self):
+        with self.lock:
+            self.servers = {}
+
+    def on_event(self, event):
+        """
+        Event listener evicting servers that were started or stopped.
+        """
+        if event['type'] in ('server_started', 'server_stopped'):
+            self.discard(event['server_id'])
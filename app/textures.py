@@ -0,0 +1,138 @@
+"""
+textures.py
+LRU cache of user textures (avatars), bounded by total size in bytes.
+
+:copyright: (C) 2014 by github.com/alfg.
+:license:   MIT, see README for more details.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import settings
+
+from app import events
+
+# Total bytes of textures kept in memory.
+TEXTURE_CACHE_BYTES = getattr(settings, 'TEXTURE_CACHE_BYTES', 16 * 1024 * 1024)
+
+# Seconds a cached texture is served before it is fetched again.
+TEXTURE_CACHE_TTL = getattr(settings, 'TEXTURE_CACHE_TTL', 300)
+
+# Accounted per entry on top of the texture itself, so empty textures still count.
+ENTRY_OVERHEAD = 128
+
+SIGNATURES = (
+    ('\x89PNG\r\n\x1a\n', 'image/png'),
+    ('\xff\xd8\xff', 'image/jpeg'),
+    ('GIF87a', 'image/gif'),
+    ('GIF89a', 'image/gif'),
+    ('BM', 'image/bmp'),
+)
+
+
+def content_type(data):
+    """
+    Guesses the content type of a texture from its leading bytes.
+    """
+    for signature, mimetype in SIGNATURES:
+        if data.startswith(signature):
+            return mimetype
+    return 'application/octet-stream'
+
+
+class Texture(object):
+    """
+    A cached texture. `data` is the buffer returned by Ice, kept as is.
+    """
+    __slots__ = ('data', 'etag', 'content_type', 'fetched')
+
+    def __init__(self, data):
+        self.data = data
+        self.etag = hashlib.sha1(data).hexdigest()
+        self.content_type = content_type(data)
+        self.fetched = time.time()
+
+
+class TextureCache(object):
+    """
+    LRU mapping of (server id, userid) to Texture, evicting least recently used
+    entries once the total size exceeds the byte budget.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        # Invalidation counters per (server id, userid) and per server id
+        self.generations = {}
+        self.server_generations = {}
+
+    def _generation(self, key):
+        # Caller holds self.lock
+        return self.generations.get(key, 0), self.server_generations.get(key[0], 0)
+
+    def get(self, server_id, userid, fetch):
+        """
+        Gets a texture, calling fetch() to load it on a miss. The fetched
+        texture is not cached if the key was invalidated during the fetch.
+        """
+        key = (server_id, userid)
+        with self.lock:
+            generation = self._generation(key)
+            texture = self.entries.pop(key, None)
+            if texture is not None:
+                if time.time() - texture.fetched < self.ttl:
+                    self.entries[key] = texture
+                    return texture
+                self.bytes -= len(texture.data) + ENTRY_OVERHEAD
+
+        texture = Texture(fetch())
+        size = len(texture.data) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return texture
+
+        with self.lock:
+            if self._generation(key) != generation:
+                return texture
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old.data) + ENTRY_OVERHEAD
+            self.entries[key] = texture
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                k, evicted = self.entries.popitem(last=False)
+                self.bytes -= len(evicted.data) + ENTRY_OVERHEAD
+        return texture
+
+    def invalidate(self, server_id, userid=None):
+        """
+        Drops a user's texture, or all textures of a server if userid is None.
+        """
+        with self.lock:
+            if userid is not None:
+                keys = [(server_id, userid)]
+                self.generations[keys[0]] = self.generations.get(keys[0], 0) + 1
+            else:
+                keys = [k for k in self.entries if k[0] == server_id]
+                self.server_generations[server_id] = self.server_generations.get(server_id, 0) + 1
+            for key in keys:
+                texture = self.entries.pop(key, None)
+                if texture is not None:
+                    self.bytes -= len(texture.data) + ENTRY_OVERHEAD
+
+
+textures = TextureCache(TEXTURE_CACHE_BYTES, TEXTURE_CACHE_TTL)
+
+
+@events.subscribe
+def invalidate_changed_users(event):
+    """
+    Drops cached textures of registered users whose state changed on the server.
+    """
+    if event['type'] in ('user_connected', 'user_state_changed') and event['data'].userid >= 0:
+        textures.invalidate(event['server_id'], event['data'].userid)
@@ -0,0 +1,119 @@
+"""
+tokenauth.py
+Bearer token / API key authentication.
+
+Keys are configured as hashes in settings.API_KEYS, either "sha256$<hex>" or
+"pbkdf2_sha256$<iterations>$<salt>$<hex>". Verified keys are remembered per
+process by a fast digest, so the slow hash is only computed once per key.
+
+:copyright: (C) 2014 by github.com/alfg.
+:license:   MIT, see README for more details.
+"""
+
+import hashlib
+import hmac
+import threading
+from functools import wraps
+
+from flask import request, jsonify
+
+# Maximum number of verified keys remembered per process.
+CACHE_SIZE = 1024
+
+
+def _compare_digest(a, b):
+    """
+    Constant-time string comparison, for Pythons older than 2.7.7.
+    """
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+compare_digest = getattr(hmac, 'compare_digest', _compare_digest)
+
+
+def hash_key(key, iterations=None, salt=None):
+    """
+    Hashes an API key for use in settings.API_KEYS. PBKDF2 requires Python 2.7.8+.
+    """
+    if iterations:
+        digest = hashlib.pbkdf2_hmac('sha256', key, salt, int(iterations))
+        return 'pbkdf2_sha256$%d$%s$%s' % (int(iterations), salt, digest.encode('hex'))
+    return 'sha256$' + hashlib.sha256(key).hexdigest()
+
+
+def verify_key(key, hashed):
+    """
+    Checks a key against a stored hash in constant time.
+    """
+    parts = hashed.split('$')
+    if parts[0] == 'pbkdf2_sha256' and len(parts) == 4 and hasattr(hashlib, 'pbkdf2_hmac'):
+        candidate = hash_key(key, parts[1], parts[2])
+    elif parts[0] == 'sha256' and len(parts) == 2:
+        candidate = hash_key(key)
+    else:
+        return False
+    return compare_digest(candidate, hashed)
+
+
+class TokenAuth(object):
+    """
+    Authenticates requests carrying "Authorization: Bearer <key>" or
+    "X-API-Key: <key>". Requests without a key are passed to `fallback`
+    (e.g. HTTPDigestAuth) if given, otherwise rejected.
+    """
+
+    def __init__(self, keys, fallback=None):
+        self.keys = keys
+        self.fallback = fallback
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def get_token(self):
+        header = request.headers.get('Authorization', '')
+        if header[:7].lower() == 'bearer ':
+            return header[7:].strip()
+        return request.headers.get('X-API-Key')
+
+    def authenticate(self, token):
+        """
+        Returns the name of the key matching the token, or None.
+        """
+        if isinstance(token, unicode):
+            token = token.encode('utf-8')
+        fast = hashlib.sha256(token).digest()
+        name = self.cache.get(fast)
+        if name is not None:
+            return name
+
+        # Check every key so timing does not reveal which one matched
+        name = None
+        for key_name, hashed in self.keys.items():
+            if verify_key(token, hashed) and name is None:
+                name = key_name
+
+        if name is not None:
+            with self.lock:
+                if len(self.cache) >= CACHE_SIZE:
+                    self.cache.clear()
+                self.cache[fast] = name
+        return name
+
+    def login_required(self, f):
+        digest_protected = self.fallback.login_required(f) if self.fallback else None
+
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            token = self.get_token()
+            if not token and digest_protected:
+                return digest_protected(*args, **kwargs)
+            if not token or self.authenticate(token) is None:
+                response = jsonify(message="Unauthorized Access")
+                response.status_code = 401
+                response.headers['WWW-Authenticate'] = 'Bearer realm="Authentication Required"'
+                return response
+            return f(*args, **kwargs)
+        return decorated
@@ -0,0 +1,164 @@
+"""
+userindex.py
+Index of online users across all servers, by name and address.
+
+While Murmur callbacks are registered the index is kept current from user
+connect, disconnect and state events, and only rebuilt occasionally to
+correct drift. Events arriving during a rebuild are replayed on top of it.
+Without callbacks, or if the index predates the last time callbacks were
+(re)registered, it is rebuilt by a concurrent getUsers() fan-out once it is
+older than a short TTL.
+
+:copyright: (C) 2014 by github.com/alfg.
+:license:   MIT, see README for more details.
+"""
+
+import threading
+import time
+
+import settings
+
+from app import events
+from app.bans import address_bytes, format_address, network
+from app.fanout import pipeline, server_id
+
+# Seconds before the index is rebuilt, without and with live callbacks.
+USER_INDEX_TTL = getattr(settings, 'USER_INDEX_TTL', 5)
+USER_INDEX_LIVE_TTL = getattr(settings, 'USER_INDEX_LIVE_TTL', 300)
+
+
+def user_entry(sid, user):
+    address = address_bytes(user.address)
+    return {
+        'server_id': sid,
+        'session': user.session,
+        'userid': user.userid,
+        'name': user.name,
+        'channel': user.channel,
+        'address': format_address(address),
+        '_address': address,
+    }
+
+
+class UserIndex(object):
+    """
+    Online users keyed by (server id, session), with name and address indexes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        self.users = {}
+        self.by_name = {}
+        self.by_address = {}
+        self.built = 0
+        # Events received while a rebuild is in progress, or None
+        self.pending = None
+
+    def _add(self, key, entry):
+        self._remove(key)
+        self.users[key] = entry
+        self.by_name.setdefault(entry['name'].lower(), set()).add(key)
+        self.by_address.setdefault(entry['_address'], set()).add(key)
+
+    def _remove(self, key):
+        entry = self.users.pop(key, None)
+        if entry is None:
+            return
+        for index, value in ((self.by_name, entry['name'].lower()), (self.by_address, entry['_address'])):
+            keys = index.get(value)
+            keys.discard(key)
+            if not keys:
+                del index[value]
+
+    def _apply(self, event):
+        # Caller holds self.lock
+        sid = event['server_id']
+        if event['type'] in ('user_connected', 'user_state_changed'):
+            self._add((sid, event['data'].session), user_entry(sid, event['data']))
+        elif event['type'] == 'user_disconnected':
+            self._remove((sid, event['data'].session))
+        elif event['type'] == 'server_stopped':
+            for key in [k for k in self.users if k[0] == sid]:
+                self._remove(key)
+
+    def on_event(self, event):
+        """
+        Event listener keeping the index current.
+        """
+        with self.lock:
+            self._apply(event)
+            if self.pending is not None:
+                self.pending.append(event)
+
+    def stale(self):
+        """
+        True if the index is older than its TTL. The longer TTL only applies
+        while callbacks are registered and were already when it was built.
+        """
+        live = events.active and self.built >= events.attached_at
+        return time.time() - self.built >= (USER_INDEX_LIVE_TTL if live else USER_INDEX_TTL)
+
+    def refresh(self, meta):
+        """
+        Rebuilds the index from all booted servers if it is out of date.
+        """
+        if not self.stale():
+            return
+
+        with self.build_lock:
+            # Another request may have rebuilt it while we waited
+            if not self.stale():
+                return
+
+            started = time.time()
+            with self.lock:
+                self.pending = []
+            try:
+                servers = [(server_id(s), s) for s in meta.getBootedServers()]
+                entries = []
+                for sid, users, error in pipeline((sid, s, 'getUsers', ()) for sid, s in servers):
+                    if error is None:
+                        entries.extend(((sid, u.session), user_entry(sid, u)) for u in users.values())
+            except:
+                with self.lock:
+                    self.pending = None
+                raise
+
+            with self.lock:
+                self.users, self.by_name, self.by_address = {}, {}, {}
+                for key, entry in entries:
+                    self._add(key, entry)
+                # Events seen since the rebuild started may not be in getUsers() yet
+                for event in self.pending:
+                    self._apply(event)
+                self.pending = None
+                self.built = started
+
+    def search(self, name=None, address=None, partial=False):
+        """
+        Finds users by name (case-insensitive, exact or partial) and/or by
+        address (an IP or a CIDR range, as parsed by app.bans.parse_cidr).
+        """
+        with self.lock:
+            if name and not partial:
+                keys = set(self.by_name.get(name.lower(), ()))
+            elif name:
+                keys = set(k for k, e in self.users.iteritems() if name.lower() in e['name'].lower())
+            else:
+                keys = set(self.users)
+
+            if address:
+                addr, bits = address
+                if bits == 128:
+                    keys &= self.by_address.get(addr, set())
+                else:
+                    net = network(addr, bits)
+                    keys = set(k for k in keys if network(self.users[k]['_address'], bits) == net)
+
+            return [dict((f, v) for f, v in self.users[k].iteritems() if not f.startswith('_'))
+                    for k in sorted(keys)]
+
+
+users = UserIndex()
+events.subscribe(users.on_event)
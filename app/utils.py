@@ -6,14 +6,21 @@ Utilities used within the application.
 :license:   MIT, see README for more details.
 """
 
+import fcntl
+import logging
+import threading
+import time
+
 from flask import request, current_app
 from functools import wraps
 
 from settings import USERS as users
-from app import auth
+from app import digest_auth
+
+log = logging.getLogger(__name__)
 
 
-@auth.get_password
+@digest_auth.get_password
 def get_pw(username):
     """
     Required get_password function used for flask-httpauth.
@@ -101,3 +108,49 @@ def support_jsonp(f):
         else:
             return f(*args, **kwargs)
     return decorated_function
+
+
+_lock_files = {}
+
+
+def hold_lock_file(path):
+    """
+    Takes an exclusive lock on `path` for the life of the process, so a
+    background task runs in only one worker process. Returns False if another
+    process holds it.
+    """
+    lock_file = open(path, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lock_file.close()
+        return False
+    _lock_files[path] = lock_file
+    return True
+
+
+def is_true(value):
+    """
+    Parses a boolean flag from a form or query string value.
+    """
+    return (value or '').lower() in ('1', 'true', 'yes')
+
+
+def start_loop(name, interval, func, *args):
+    """
+    Starts a daemon thread calling func(*args) every `interval` seconds.
+    Errors, such as Murmur being unavailable or a circuit being open, are
+    logged and the loop carries on.
+    """
+    def run():
+        while True:
+            try:
+                func(*args)
+            except Exception:
+                log.exception("%s failed", name)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name=name)
+    thread.daemon = True
+    thread.start()
+    return thread
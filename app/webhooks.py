@@ -0,0 +1,262 @@
+"""
+webhooks.py
+Outbound webhook delivery of Murmur events.
+
+Events are put on a bounded queue by the event listener and never block Ice
+threads; when the queue is full they are dropped and counted. A batcher thread
+groups events per endpoint, coalescing rapid state changes of the same user or
+channel. Each endpoint has its own delivery queue and workers POSTing the
+batches as JSON, retrying with exponential backoff, so a slow or dead receiver
+only drops its own batches and never delays the others.
+
+:copyright: (C) 2014 by github.com/alfg.
+:license:   MIT, see README for more details.
+"""
+
+import httplib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import urllib2
+from Queue import Queue, Empty, Full
+
+import settings
+
+from app import events
+from app.bans import format_address
+from app.utils import obj_to_dict, hold_lock_file
+
+# Webhook endpoints, either URLs or dicts with 'url' and optionally 'events' (list of event types).
+WEBHOOKS = getattr(settings, 'WEBHOOKS', [])
+
+WEBHOOK_QUEUE_SIZE = getattr(settings, 'WEBHOOK_QUEUE_SIZE', 10000)
+WEBHOOK_BATCH_SIZE = getattr(settings, 'WEBHOOK_BATCH_SIZE', 100)
+WEBHOOK_BATCH_INTERVAL = getattr(settings, 'WEBHOOK_BATCH_INTERVAL', 1.0)
+# Delivery workers per endpoint.
+WEBHOOK_WORKERS = getattr(settings, 'WEBHOOK_WORKERS', 2)
+WEBHOOK_RETRIES = getattr(settings, 'WEBHOOK_RETRIES', 5)
+WEBHOOK_BACKOFF = getattr(settings, 'WEBHOOK_BACKOFF', 0.5)
+WEBHOOK_TIMEOUT = getattr(settings, 'WEBHOOK_TIMEOUT', 5)
+
+# Only the worker process holding this lock delivers webhooks.
+WEBHOOK_LOCK_FILE = getattr(settings, 'WEBHOOK_LOCK_FILE', os.path.join(settings.MURMUR_ROOT, '.webhooks.lock'))
+
+# Event types only sent to endpoints that list them in 'events', since they carry chat content.
+OPT_IN_EVENTS = ('user_text_message',)
+
+# Event types where only the latest event per user or channel matters.
+COALESCED = {
+    'user_state_changed': 'session',
+    'channel_state_changed': 'id',
+}
+
+log = logging.getLogger(__name__)
+
+
+def coalesce(batch):
+    """
+    Keeps only the last state change per (type, server, user or channel),
+    preserving the order of the remaining events.
+    """
+    seen = set()
+    kept = []
+    for event in reversed(batch):
+        attr = COALESCED.get(event['type'])
+        if attr is not None:
+            key = (event['type'], event['server_id'], getattr(event['data'], attr))
+            if key in seen:
+                continue
+            seen.add(key)
+        kept.append(event)
+    kept.reverse()
+    return kept
+
+
+def readable(value):
+    """
+    Formats NetAddress fields, raw bytes from Ice, as IP address strings.
+    """
+    if isinstance(value, dict):
+        return dict((k, format_address(v) if k == 'address' and isinstance(v, (str, list))
+                     else readable(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return [readable(v) for v in value]
+    return value
+
+
+def event_to_dict(event):
+    return dict(event, data=readable(obj_to_dict(event['data'])) if event['data'] is not None else None)
+
+
+class Endpoint(object):
+    """
+    A webhook endpoint and its delivery metrics.
+    """
+
+    def __init__(self, config):
+        if isinstance(config, basestring):
+            config = {'url': config}
+        self.url = config['url']
+        self.events = set(config.get('events') or [])
+        self.deliveries = Queue(WEBHOOK_WORKERS * 4)
+        self.metrics = {
+            'batches_sent': 0,
+            'batches_failed': 0,
+            'batches_dropped': 0,
+            'events_sent': 0,
+            'retries': 0,
+            'last_error': None,
+            'last_success': None,
+        }
+
+    def wants(self, event):
+        if event['type'] in self.events:
+            return True
+        return not self.events and event['type'] not in OPT_IN_EVENTS
+
+
+class WebhookDispatcher(object):
+    """
+    Queues, batches and delivers events to webhook endpoints.
+    """
+
+    def __init__(self, endpoints):
+        self.endpoints = [Endpoint(e) for e in endpoints]
+        self.queue = Queue(WEBHOOK_QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.metrics = {
+            'events_received': 0,
+            'events_dropped': 0,
+            'events_coalesced': 0,
+        }
+
+    def count(self, metrics, key, n=1):
+        with self.lock:
+            metrics[key] += n
+
+    def enqueue(self, event):
+        """
+        Event listener. Never blocks the calling Ice thread.
+        """
+        self.count(self.metrics, 'events_received')
+        try:
+            self.queue.put_nowait(event)
+        except Full:
+            self.count(self.metrics, 'events_dropped')
+
+    def next_batch(self):
+        """
+        Waits for an event, then collects more until the batch is full or the interval passes.
+        """
+        batch = [self.queue.get()]
+        deadline = time.time() + WEBHOOK_BATCH_INTERVAL
+        while len(batch) < WEBHOOK_BATCH_SIZE:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def dispatch(self, batch):
+        """
+        Hands a batch to each endpoint's workers, dropping it for endpoints
+        whose workers are behind.
+        """
+        for endpoint in self.endpoints:
+            events_ = [e for e in batch if endpoint.wants(e)]
+            kept = coalesce(events_)
+            self.count(self.metrics, 'events_coalesced', len(events_) - len(kept))
+            if not kept:
+                continue
+            payload = json.dumps({'events': [event_to_dict(e) for e in kept]})
+            try:
+                endpoint.deliveries.put_nowait((payload, len(kept)))
+            except Full:
+                self.count(endpoint.metrics, 'batches_dropped')
+
+    def run_batcher(self):
+        while True:
+            try:
+                self.dispatch(self.next_batch())
+            except Exception:
+                # e.g. an event that can't be serialized; lose the batch, not the thread
+                log.exception("Webhook batch failed")
+
+    def run_worker(self, endpoint):
+        while True:
+            payload, count = endpoint.deliveries.get()
+            try:
+                self.deliver(endpoint, payload, count)
+            except Exception, e:
+                # e.g. a malformed URL; lose the batch, not the worker
+                endpoint.metrics['last_error'] = str(e)
+                self.count(endpoint.metrics, 'batches_failed')
+                log.exception("Webhook delivery to %s failed", endpoint.url)
+
+    def deliver(self, endpoint, payload, count):
+        """
+        POSTs a batch, retrying network errors, 429 and 5xx with exponential backoff.
+        """
+        for attempt in xrange(WEBHOOK_RETRIES + 1):
+            if attempt:
+                self.count(endpoint.metrics, 'retries')
+                time.sleep(WEBHOOK_BACKOFF * 2 ** (attempt - 1))
+            try:
+                request = urllib2.Request(endpoint.url, payload, {'Content-Type': 'application/json'})
+                urllib2.urlopen(request, timeout=WEBHOOK_TIMEOUT).close()
+            except urllib2.HTTPError, e:
+                endpoint.metrics['last_error'] = 'HTTP %d' % e.code
+                if e.code != 429 and e.code < 500:
+                    break
+            except (urllib2.URLError, socket.error, httplib.HTTPException), e:
+                endpoint.metrics['last_error'] = str(e)
+            else:
+                self.count(endpoint.metrics, 'batches_sent')
+                self.count(endpoint.metrics, 'events_sent', count)
+                endpoint.metrics['last_success'] = time.time()
+                return True
+
+        self.count(endpoint.metrics, 'batches_failed')
+        log.warning("Webhook delivery to %s failed: %s", endpoint.url, endpoint.metrics['last_error'])
+        return False
+
+    def start(self):
+        threads = [threading.Thread(target=self.run_batcher, name='webhook-batcher')]
+        threads += [threading.Thread(target=self.run_worker, args=(endpoint,),
+                                     name='webhook-worker-%d-%d' % (n, i))
+                    for n, endpoint in enumerate(self.endpoints) for i in xrange(WEBHOOK_WORKERS)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+    def stats(self):
+        with self.lock:
+            data = dict(self.metrics, queued=self.queue.qsize(), endpoints=[
+                dict(e.metrics, url=e.url, queued=e.deliveries.qsize()) for e in self.endpoints
+            ])
+        return data
+
+
+dispatcher = None
+
+
+def start_webhooks():
+    """
+    Starts webhook delivery if endpoints are configured and no other worker
+    process is already delivering. Returns the dispatcher or None.
+    """
+    global dispatcher
+
+    if not WEBHOOKS or not hold_lock_file(WEBHOOK_LOCK_FILE):
+        return None
+
+    dispatcher = WebhookDispatcher(WEBHOOKS)
+    dispatcher.start()
+    events.subscribe(dispatcher.enqueue)
+    return dispatcher
@@ -0,0 +1,224 @@
+"""
+test_webhooks.py
+Webhook delivery against local HTTP receivers.
+
+The app package connects to Murmur when imported, so app.webhooks is loaded
+on its own with settings, Murmur and the app modules it uses stubbed out.
+
+Run with: python -m unittest discover tests
+
+:copyright: (C) 2014 by github.com/alfg.
+:license:   MIT, see README for more details.
+"""
+
+import imp
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def stub(name, **attrs):
+    module = imp.new_module(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    package, _, child = name.rpartition('.')
+    if package:
+        setattr(sys.modules[package], child, module)
+    return module
+
+
+def obj_to_dict(obj):
+    # Same conversion as app.utils.obj_to_dict, which needs Flask and a Murmur connection
+    if isinstance(obj, dict):
+        return dict((k, obj_to_dict(v)) for k, v in obj.iteritems())
+    if hasattr(obj, '__dict__'):
+        return obj_to_dict(obj.__dict__)
+    return obj
+
+
+def load_webhooks():
+    stub('settings', MURMUR_ROOT=tempfile.gettempdir(), WEBHOOK_BATCH_INTERVAL=0.05,
+         WEBHOOK_BACKOFF=0.01, WEBHOOK_RETRIES=2, WEBHOOK_TIMEOUT=1, WEBHOOK_WORKERS=1)
+    stub('Murmur')
+    stub('app', __path__=[os.path.join(ROOT, 'app')])
+    stub('app.events', subscribe=lambda listener: listener)
+    stub('app.utils', obj_to_dict=obj_to_dict, hold_lock_file=lambda path: True)
+    return imp.load_source('app.webhooks', os.path.join(ROOT, 'app', 'webhooks.py'))
+
+webhooks = load_webhooks()
+
+
+class Receiver(object):
+    """
+    Local webhook receiver answering with `status`, optionally after `delay` seconds.
+    """
+
+    def __init__(self, status=200, delay=0):
+        self.batches = []
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                time.sleep(receiver.delay)
+                receiver.batches.append(json.loads(body))
+                self.send_response(receiver.status)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.status = status
+        self.delay = delay
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def events(self):
+        return [e for batch in self.batches for e in batch['events']]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class User(object):
+    def __init__(self, session, name, address='\x00' * 10 + '\xff\xff\x0a\x00\x00\x01'):
+        self.session = session
+        self.name = name
+        self.address = address
+
+
+def event(event_type, data):
+    return {'type': event_type, 'server_id': 1, 'timestamp': time.time(), 'data': data}
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class WebhookTest(unittest.TestCase):
+
+    def setUp(self):
+        self.receivers = []
+
+    def tearDown(self):
+        for receiver in self.receivers:
+            receiver.close()
+
+    def receiver(self, **kwargs):
+        receiver = Receiver(**kwargs)
+        self.receivers.append(receiver)
+        return receiver
+
+    def dispatcher(self, *endpoints):
+        dispatcher = webhooks.WebhookDispatcher(endpoints)
+        dispatcher.start()
+        return dispatcher
+
+    def test_delivers_coalesced_batch(self):
+        receiver = self.receiver()
+        dispatcher = self.dispatcher(receiver.url)
+
+        dispatcher.enqueue(event('user_connected', User(1, 'a')))
+        for name in ('b', 'c', 'd'):
+            dispatcher.enqueue(event('user_state_changed', User(1, name)))
+
+        self.assertTrue(wait_for(lambda: receiver.batches))
+        events = receiver.events()
+        self.assertEqual([e['type'] for e in events], ['user_connected', 'user_state_changed'])
+        self.assertEqual(events[1]['data']['name'], 'd')
+        self.assertEqual(events[0]['data']['address'], '10.0.0.1')
+        self.assertTrue(wait_for(lambda: dispatcher.stats()['events_coalesced'] == 2))
+
+    def test_filters_event_types(self):
+        receiver = self.receiver()
+        dispatcher = self.dispatcher({'url': receiver.url, 'events': ['user_disconnected']})
+
+        dispatcher.enqueue(event('user_connected', User(1, 'a')))
+        dispatcher.enqueue(event('user_disconnected', User(1, 'a')))
+
+        self.assertTrue(wait_for(lambda: receiver.batches))
+        self.assertEqual([e['type'] for e in receiver.events()], ['user_disconnected'])
+
+    def test_text_messages_are_opt_in(self):
+        receiver = self.receiver()
+        chat = self.receiver()
+        dispatcher = self.dispatcher(receiver.url, {'url': chat.url, 'events': ['user_text_message']})
+
+        dispatcher.enqueue(event('user_text_message', {'user': User(1, 'a'), 'message': 'hi'}))
+        dispatcher.enqueue(event('user_connected', User(2, 'b')))
+
+        self.assertTrue(wait_for(lambda: receiver.batches and chat.batches))
+        self.assertEqual([e['type'] for e in receiver.events()], ['user_connected'])
+        self.assertEqual([e['type'] for e in chat.events()], ['user_text_message'])
+
+    def test_worker_survives_bad_url(self):
+        dispatcher = self.dispatcher('foo')
+
+        for session in xrange(2):
+            dispatcher.enqueue(event('user_connected', User(session, 'a')))
+            time.sleep(0.2)
+
+        metrics = lambda: dispatcher.stats()['endpoints'][0]
+        self.assertTrue(wait_for(lambda: metrics()['batches_failed'] == 2))
+        self.assertEqual(metrics()['batches_dropped'], 0)
+
+    def test_retries_server_errors(self):
+        receiver = self.receiver(status=503)
+        dispatcher = self.dispatcher(receiver.url)
+
+        dispatcher.enqueue(event('user_connected', User(1, 'a')))
+
+        metrics = lambda: dispatcher.stats()['endpoints'][0]
+        self.assertTrue(wait_for(lambda: metrics()['batches_failed'] == 1))
+        self.assertEqual(len(receiver.batches), webhooks.WEBHOOK_RETRIES + 1)
+        self.assertEqual(metrics()['last_error'], 'HTTP 503')
+
+    def test_does_not_retry_client_errors(self):
+        receiver = self.receiver(status=400)
+        dispatcher = self.dispatcher(receiver.url)
+
+        dispatcher.enqueue(event('user_connected', User(1, 'a')))
+
+        self.assertTrue(wait_for(lambda: dispatcher.stats()['endpoints'][0]['batches_failed'] == 1))
+        self.assertEqual(len(receiver.batches), 1)
+
+    def test_slow_endpoint_does_not_delay_others(self):
+        slow = self.receiver(delay=0.5)
+        healthy = self.receiver()
+        dispatcher = self.dispatcher(slow.url, healthy.url)
+
+        for session in xrange(20):
+            dispatcher.enqueue(event('user_connected', User(session, 'u%d' % session)))
+            time.sleep(0.06)
+
+        self.assertTrue(wait_for(lambda: len(healthy.events()) == 20, timeout=2))
+        self.assertLess(len(slow.events()), 20)
+
+    def test_batcher_survives_bad_event(self):
+        receiver = self.receiver()
+        dispatcher = self.dispatcher(receiver.url)
+
+        dispatcher.enqueue(event('user_connected', User(1, 'a', address='\xff')))
+        time.sleep(0.2)
+        dispatcher.enqueue(event('user_connected', User(2, 'b')))
+
+        self.assertTrue(wait_for(lambda: receiver.batches))
+        self.assertEqual([e['data']['name'] for e in receiver.events()], ['b'])
+
+
+if __name__ == '__main__':
+    unittest.main()